@@ -1,9 +1,14 @@
+import os
+import sys
 import random
 import math
 import numpy as np
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from noise import eventRng, electronicNoiseStream
+
 def makeBranch(tree, name, t):
     b = None
     if t == "vector":
@@ -27,9 +32,11 @@ def rand(m=0,M=100):
 def randgauss(m,w):
     return random.gauss(m,w)
     
-def noise1D(histo):
-    for b in range(histo.GetXaxis().GetNbins()+1):
-        histo.SetBinContent(b, randgauss(0, 0.5))
+def noise1D(histo, rng):
+    # Noise for the underflow and all bins in one draw; the overflow keeps its content
+    nBins = histo.GetXaxis().GetNbins()
+    content = np.append(rng.normal(0, 0.5, nBins+1), histo.GetBinContent(nBins+1))
+    histo.SetContent(content)
     return histo
 
 def hitOneArray(h, t):
@@ -42,6 +49,7 @@ def main():
     nEvents = 1
     outfile = "dSIPMs.root"
     fiberWidth = 0.2
+    seed = 0
 
     # Define TTrees and TBranches
     root_file = ROOT.TFile(outfile, "RECREATE")
@@ -67,7 +75,7 @@ def main():
     for c in nChannels: histos["signal_time_{}".format(c[0])] = ROOT.TH1D("signal_time_{}".format(c[0]),"signal_time; time [ns]; Amplitude [mV]", 500,0.0,25.0)
 
     # Loop over events
-    for i in range(nEvents):
+    for iEvent in range(nEvents):
         #############################################
         # Generate photon distribution
         #############################################
@@ -99,8 +107,10 @@ def main():
             for c in nChannels:
                 if(hitOneArray(histos["nPhotons_xy_{}".format(c[0])], t)): histos["nPhotons_time_{}".format(c[0])].Fill(t[1], t[0])
 
+        # One noise stream per event, drawn channel after channel, so the toy is reproducible
+        rng = eventRng(seed, iEvent, electronicNoiseStream)
         for c in nChannels: 
-            histos["signal_time_{}".format(c[0])] = noise1D(histos["signal_time_{}".format(c[0])])
+            histos["signal_time_{}".format(c[0])] = noise1D(histos["signal_time_{}".format(c[0])], rng)
             histos["signal_time_{}".format(c[0])].Add(histos["nPhotons_time_{}".format(c[0])])
 
         # # Save to TTree
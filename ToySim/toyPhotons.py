@@ -0,0 +1,151 @@
+import os
+import sys
+import argparse
+import numpy as np
+import ROOT
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import simSPADs
+from eventReader import EventChunk
+
+ROOT.gROOT.SetBatch(True)
+
+#############################################
+# Photon generation
+#############################################
+
+def generateEvent(rng, nPhotons, nFibersX=3, nFibersY=3, fiberPitch=0.1, fiberWidth=0.02, coreCFraction=0.8, timeDecay=8.0, timeSpread=10.0):
+    """
+    OP_* columns of one event. Photons come out of a nFibersX x nFibersY grid
+    of fibers with Gaussian spots of width fiberWidth [cm] around each fiber,
+    in the frame after the simSPADs fiber shifts. Arrival times are an
+    exponential with timeDecay [ns] on top of a uniform 0-timeSpread ns
+    spread, in random order as in Geant4.
+    """
+    fx = (np.arange(nFibersX) - 0.5*(nFibersX - 1))*fiberPitch
+    fy = (np.arange(nFibersY) - 0.5*(nFibersY - 1))*fiberPitch
+    fiber = rng.integers(0, nFibersX*nFibersY, nPhotons)
+    productionFiber = (fiber % len(simSPADs.xShift)).astype(np.int32)
+    return {
+        "OP_time_final":      rng.exponential(timeDecay, nPhotons) + rng.uniform(0.0, timeSpread, nPhotons),
+        "OP_pos_final_x":     fx[fiber % nFibersX] + rng.normal(0.0, fiberWidth, nPhotons) - np.asarray(simSPADs.xShift)[productionFiber],
+        "OP_pos_final_y":     fy[fiber // nFibersX] + rng.normal(0.0, fiberWidth, nPhotons) - np.asarray(simSPADs.yShift)[productionFiber],
+        "OP_pos_final_z":     rng.uniform(-1.0, 100.0, nPhotons),
+        "OP_pos_produced_z":  rng.uniform(-100.0, 0.0, nPhotons),
+        "OP_productionFiber": productionFiber,
+        "OP_isCoreC":         (rng.random(nPhotons) < coreCFraction).astype(np.int32),
+    }
+
+def generateChunk(nEvents, nPhotons, seed=1, firstEntry=0, **config):
+    """
+    EventChunk of nEvents toy events with a Poisson(nPhotons) photon yield
+    each. Every event has its own generator seeded with (seed, entry), so an
+    event does not depend on how the sample is split into chunks.
+    """
+    events = []
+    for entry in range(firstEntry, firstEntry + nEvents):
+        rng = np.random.default_rng([seed, entry])
+        events.append(generateEvent(rng, rng.poisson(nPhotons), **config))
+    offsets = np.zeros(nEvents + 1, dtype=np.int64)
+    np.cumsum([len(e["OP_time_final"]) for e in events], out=offsets[1:])
+    columns = {name: np.concatenate([e[name] for e in events]) for name in events[0]} if events else {}
+    return EventChunk(firstEntry, offsets, columns)
+
+def generateChunks(nEvents, nPhotons, chunkSize=10, seed=1, **config):
+    # The sample in chunks of chunkSize events, so memory stays bounded
+    for first in range(0, nEvents, chunkSize):
+        yield generateChunk(min(chunkSize, nEvents - first), nPhotons, seed, first, **config)
+
+#############################################
+# Bulk tree writing
+#############################################
+
+# Fills one tree entry per event from the flat columns of a chunk, in compiled code
+writerCode = """
+#include "TTree.h"
+#include <cstdint>
+#include <vector>
+
+struct ToyOPWriter {
+    TTree* tree;
+    std::vector<double> t, x, y, z, zProduced;
+    std::vector<int> fiber, isCoreC;
+
+    ToyOPWriter(TTree* tr) : tree(tr) {
+        tree->Branch("OP_time_final", &t);
+        tree->Branch("OP_pos_final_x", &x);
+        tree->Branch("OP_pos_final_y", &y);
+        tree->Branch("OP_pos_final_z", &z);
+        tree->Branch("OP_pos_produced_z", &zProduced);
+        tree->Branch("OP_productionFiber", &fiber);
+        tree->Branch("OP_isCoreC", &isCoreC);
+    }
+
+    void fill(int64_t nEvents, const int64_t* offsets, const double* ti, const double* xi, const double* yi,
+              const double* zi, const double* zpi, const int* fi, const int* ci) {
+        for (int64_t e = 0; e < nEvents; ++e) {
+            int64_t lo = offsets[e], hi = offsets[e+1];
+            t.assign(ti + lo, ti + hi);
+            x.assign(xi + lo, xi + hi);
+            y.assign(yi + lo, yi + hi);
+            z.assign(zi + lo, zi + hi);
+            zProduced.assign(zpi + lo, zpi + hi);
+            fiber.assign(fi + lo, fi + hi);
+            isCoreC.assign(ci + lo, ci + hi);
+            tree->Fill();
+        }
+    }
+};
+"""
+
+def declareWriter():
+    if not hasattr(ROOT, "ToyOPWriter"):
+        ROOT.gInterpreter.Declare(writerCode)
+
+def writeChunks(path, chunks):
+    """
+    Write chunks to a tree named "tree" with the OP_* std::vector branches of
+    the Geant4 output, one entry per event. Each chunk goes to the tree in a
+    single compiled call. Returns the number of events written.
+    """
+    declareWriter()
+    f = ROOT.TFile(path, "RECREATE")
+    tree = ROOT.TTree("tree", "tree")
+    writer = ROOT.ToyOPWriter(tree)
+    nEvents = 0
+    for chunk in chunks:
+        if chunk.nEvents() == 0: continue
+        cols = chunk.columns
+        as64 = lambda name: np.ascontiguousarray(cols[name], dtype=np.float64)
+        as32 = lambda name: np.ascontiguousarray(cols[name], dtype=np.int32)
+        writer.fill(chunk.nEvents(), np.ascontiguousarray(chunk.offsets, dtype=np.int64),
+                    as64("OP_time_final"), as64("OP_pos_final_x"), as64("OP_pos_final_y"),
+                    as64("OP_pos_final_z"), as64("OP_pos_produced_z"),
+                    as32("OP_productionFiber"), as32("OP_isCoreC"))
+        nEvents += chunk.nEvents()
+    tree.Write()
+    f.Close()
+    return nEvents
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate toy optical photon events as a Geant4-like OP_* tree")
+    parser.add_argument("-o", "--output", default="toyPhotons.root", help="Output ROOT file")
+    parser.add_argument("--events", type=int, default=100, help="Number of events")
+    parser.add_argument("--photons", type=float, default=100000, help="Mean number of optical photons per event")
+    parser.add_argument("--chunk-size", type=int, default=10, help="Events generated and written at a time")
+    parser.add_argument("--fibers", type=int, nargs=2, default=[3, 3], metavar=("NX", "NY"), help="Fiber grid")
+    parser.add_argument("--fiber-pitch", type=float, default=0.1, help="Fiber pitch [cm]")
+    parser.add_argument("--fiber-width", type=float, default=0.02, help="Photon spot width per fiber [cm]")
+    parser.add_argument("--core-fraction", type=float, default=0.8, help="Fraction of photons from the Cherenkov fiber cores")
+    parser.add_argument("--time-decay", type=float, default=8.0, help="Exponential arrival time constant [ns]")
+    parser.add_argument("--time-spread", type=float, default=10.0, help="Width of the uniform arrival time spread [ns]")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    config = {"nFibersX": args.fibers[0], "nFibersY": args.fibers[1], "fiberPitch": args.fiber_pitch, "fiberWidth": args.fiber_width,
+              "coreCFraction": args.core_fraction, "timeDecay": args.time_decay, "timeSpread": args.time_spread}
+    nEvents = writeChunks(args.output, generateChunks(args.events, args.photons, args.chunk_size, args.seed, **config))
+    print("Wrote {} events to {}".format(nEvents, args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import ROOT
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ToySim"))
+import simSPADs
+from toyPhotons import generateChunk, writeChunks
+from simSPADs import Photons, SiPMInfo, getNBins, xBinL, xBinH
+from eventReader import readChunk
+from pixelMaps import pixelMapBackends
+from instrumentation import stats
+
+ROOT.gROOT.SetBatch(True)
+
+#############################################
+# Timing
+#############################################
+
+def benchmark(chunk, nChannels, backend, treePath=None, chunkSize=100):
+    """
+    Run the simSPADs.main stages over a synthetic chunk with the run
+    instrumentation switched on, and return the per-stage timings.
+    """
+    stats.enable()
+    histos, pixelMaps = simSPADs.bookHistos(nChannels, backend)
+
+    if treePath is not None:
+        f = ROOT.TFile(treePath, "READ")
+        tree = f.Get("tree")
+        for start in range(0, chunk.nEvents(), chunkSize):
+            readChunk(tree, start, min(chunkSize, chunk.nEvents() - start))
+        f.Close()
+
+    for event in chunk:
+        with stats.stage("Photons build", len(event.OP_time_final)):
+            g = Photons(event)
+        simSPADs.processEvent(histos, pixelMaps, nChannels, g, event.entry)
+
+    simSPADs.resetHistos(histos, pixelMaps)
+    stages = stats.stages
+    stats.enable(False)
+    return stages
+
+def parsePitchSets(specs):
+    # "20,30,40" -> [SiPMInfo(20, ...), ...]; no spec means the production list
+    if not specs:
+        return {"default": simSPADs.getChannels()}
+    return {spec: [SiPMInfo(p, getNBins(xBinL, xBinH, p/1000.0)) for p in map(int, spec.split(","))] for spec in specs}
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the simSPADs stages on synthetic events")
+    parser.add_argument("--events", type=int, default=20, help="Number of synthetic events")
+    parser.add_argument("--photons", type=int, default=100000, help="Mean number of optical photons per event")
+    parser.add_argument("--fibers", type=int, nargs=2, default=[3, 3], metavar=("NX", "NY"), help="Fiber grid")
+    parser.add_argument("--fiber-pitch", type=float, default=0.1, help="Fiber pitch [cm]")
+    parser.add_argument("--fiber-width", type=float, default=0.02, help="Photon spot width per fiber [cm]")
+    parser.add_argument("--pitches", action="append", help="Comma separated SiPM pitches in um; repeat for several sets")
+    parser.add_argument("--backend", choices=list(pixelMapBackends), default="sparse", help="Pixel map backend")
+    parser.add_argument("--no-tree", action="store_true", help="Skip writing and reading back a synthetic tree")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    chunk = generateChunk(args.events, args.photons, args.seed, nFibersX=args.fibers[0], nFibersY=args.fibers[1], fiberPitch=args.fiber_pitch, fiberWidth=args.fiber_width)
+    print("Synthetic sample: {} events, {} photons".format(chunk.nEvents(), chunk.nPhotons()))
+
+    treePath = None
+    if not args.no_tree:
+        treePath = os.path.join(tempfile.mkdtemp(prefix="benchSimSPADs_"), "synthetic.root")
+        writeChunks(treePath, [chunk])
+
+    results = {}
+    for name, nChannels in parsePitchSets(args.pitches).items():
+        stages = benchmark(chunk, nChannels, args.backend, treePath)
+        results[name] = stages
+        print("\nSiPM set {} ({})".format(name, ", ".join(c.name for c in nChannels)))
+        print("{:<20} {:>10} {:>14} {:>12}".format("stage", "time [s]", "items/s", "events/s"))
+        for stage, s in stages.items():
+            perSecond = s["items"]/s["seconds"] if s["seconds"] > 0 else float("inf")
+            eventsPerSecond = chunk.nEvents()/s["seconds"] if s["seconds"] > 0 else float("inf")
+            print("{:<20} {:>10.3f} {:>14.3g} {:>12.3g}".format(stage, s["seconds"], perSecond, eventsPerSecond))
+
+    if treePath is not None:
+        os.remove(treePath)
+        os.rmdir(os.path.dirname(treePath))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "nEvents": chunk.nEvents(), "nPhotons": chunk.nPhotons(), "stages": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
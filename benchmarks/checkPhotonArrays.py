@@ -0,0 +1,89 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import ROOT
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ToySim"))
+from toyPhotons import generateChunk, writeChunks
+from simSPADs import Photons, shrink_rules, shrink_toward_center, shrink_toward_center_array
+from eventReader import readChunk
+
+ROOT.gROOT.SetBatch(True)
+
+#############################################
+# Scalar vs array photon coordinates
+#############################################
+
+def scalarCoordinates(g):
+    # The per-photon accessors, one call per photon as in the original photon loop
+    n = g.nPhotons()
+    return {
+        "x":    np.array([g.x(i) for i in range(n)], dtype=np.float64),
+        "y":    np.array([g.y(i) for i in range(n)], dtype=np.float64),
+        "z":    np.array([g.z(i) for i in range(n)], dtype=np.float64),
+        "zEnd": np.array([g.zEnd(i) for i in range(n)], dtype=np.float64),
+        "t":    np.array([g.t(i) for i in range(n)], dtype=np.float64),
+    }
+
+def arrayCoordinates(g):
+    return {"x": g.xArray(), "y": g.yArray(), "z": g.zArray(), "zEnd": g.zEndArray(), "t": g.tArray()}
+
+def compareShrink(n=100001, maxVal=20.0):
+    """
+    The shrink table alone: values across every rule and past the last one,
+    plus the rule limits themselves on both sides and zero. Returns the
+    number of values the two versions do not shrink bit-identically.
+    """
+    limits = np.array([limit for limit, _ in shrink_rules])
+    vals = np.concatenate([np.linspace(-maxVal, maxVal, n), limits, -limits, [0.0]])
+    scalar = np.array([shrink_toward_center(v) for v in vals], dtype=np.float64)
+    return int(np.sum(scalar.view(np.uint64) != shrink_toward_center_array(vals).view(np.uint64)))
+
+def compare(treePath):
+    """
+    Every event of the tree through both paths: Photons of the PyROOT tree
+    event with the per-photon accessors, and Photons of the columnar reader
+    with the whole-event arrays. Returns the (entry, coordinate) pairs that
+    are not identical bit for bit.
+    """
+    f = ROOT.TFile(treePath, "READ")
+    tree = f.Get("tree")
+    chunk = readChunk(tree, 0, tree.GetEntries())
+    mismatches = []
+    for entry, event in enumerate(tree):
+        scalar = scalarCoordinates(Photons(event))
+        array = arrayCoordinates(Photons(chunk.event(entry)))
+        for name in scalar:
+            if scalar[name].tobytes() != np.ascontiguousarray(array[name], dtype=np.float64).tobytes():
+                mismatches.append((entry, name))
+    f.Close()
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the whole-event Photons arrays match the per-photon accessors bit for bit")
+    parser.add_argument("--events", type=int, default=5, help="Number of toy events")
+    parser.add_argument("--photons", type=int, default=20000, help="Mean number of optical photons per event")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    treePath = os.path.join(tempfile.mkdtemp(prefix="checkPhotonArrays_"), "toy.root")
+    # Wide fiber spots, so the photons spread over several shrink rules
+    writeChunks(treePath, [generateChunk(args.events, args.photons, args.seed, fiberWidth=0.2)])
+    mismatches = compare(treePath)
+    os.remove(treePath)
+    os.rmdir(os.path.dirname(treePath))
+
+    nShrink = compareShrink()
+    for entry, name in mismatches:
+        print("Entry {}: {} differs between the scalar and the array path".format(entry, name))
+    if nShrink:
+        print("{} values shrink differently in shrink_toward_center and shrink_toward_center_array".format(nShrink))
+    if mismatches or nShrink:
+        sys.exit(1)
+    print("{} events: scalar and array photon coordinates are identical".format(args.events))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import time
+
+def deltaPath(segmentPath):
+    return os.path.splitext(segmentPath)[0] + ".npz"
+
+class Checkpointer:
+    """
+    Append-style checkpoints for a simSPADs run. Every checkpoint writes the
+    histograms accumulated since the previous one to a new segment file, with
+    the compact pixel maps and CountHists as a delta next to it (deltaPath),
+    and then records the segment and the next entry to process in
+    state.json. Nothing written earlier is rewritten, and a resumed run
+    carries on from the recorded entry. At the end the segments add up to
+    the full output.
+    """
+    def __init__(self, ckptDir, runInfo, everyEvents=0, everyMinutes=0.0):
+        self.ckptDir = ckptDir
+        self.statePath = os.path.join(ckptDir, "state.json")
+        self.runInfo = runInfo
+        self.everyEvents = everyEvents
+        self.everyMinutes = everyMinutes
+        self.segments = []
+        self.nextEntry = None
+        self.eventsSince = 0
+        self.lastTime = time.time()
+
+    def enabled(self):
+        return self.everyEvents > 0 or self.everyMinutes > 0
+
+    def resume(self):
+        """
+        Load the state of an interrupted run. Returns the entry to restart
+        from, or None if there is nothing to resume.
+        """
+        if not os.path.exists(self.statePath):
+            return None
+        with open(self.statePath) as f:
+            state = json.load(f)
+        if state["run"] != self.runInfo:
+            raise RuntimeError("Checkpoint in {} is for a different run: {} != {}".format(self.ckptDir, state["run"], self.runInfo))
+        self.segments = [os.path.join(self.ckptDir, s) for s in state["segments"]]
+        self.nextEntry = state["nextEntry"]
+        print("Resuming from entry {} with {} checkpoint segments".format(self.nextEntry, len(self.segments)))
+        return self.nextEntry
+
+    def tick(self):
+        # Count one processed event; True when a checkpoint is due (never, if checkpointing is off)
+        self.eventsSince += 1
+        if self.everyEvents > 0 and self.eventsSince >= self.everyEvents:
+            return True
+        return self.everyMinutes > 0 and time.time() - self.lastTime >= 60*self.everyMinutes
+
+    def nextSegmentPath(self):
+        os.makedirs(self.ckptDir, exist_ok=True)
+        return os.path.join(self.ckptDir, "segment_{:04d}.root".format(len(self.segments)))
+
+    def deltaPaths(self):
+        # Compact accumulator deltas (see pixelMaps.saveDeltas) written next to each segment
+        return [deltaPath(s) for s in self.segments]
+
+    def commit(self, segmentPath, nextEntry):
+        """
+        Record a fully written segment. The state file is replaced atomically,
+        so a crash leaves either the old or the new state, never a torn one.
+        """
+        self.segments.append(segmentPath)
+        self.nextEntry = nextEntry
+        state = {
+            "run": self.runInfo,
+            "nextEntry": nextEntry,
+            "segments": [os.path.basename(s) for s in self.segments],
+        }
+        with open(self.statePath + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.statePath + ".tmp", self.statePath)
+        self.eventsSince = 0
+        self.lastTime = time.time()
+
+    def remove(self):
+        shutil.rmtree(self.ckptDir, ignore_errors=True)
@@ -0,0 +1,247 @@
+import queue
+import threading
+import time
+import numpy as np
+import ROOT
+
+from instrumentation import stats
+
+# Branches of the Geant4 tree that the SPAD simulation uses
+opBranches = [
+    "OP_time_final",
+    "OP_pos_final_x",
+    "OP_pos_final_y",
+    "OP_pos_final_z",
+    "OP_pos_produced_z",
+    "OP_productionFiber",
+    "OP_isCoreC",
+]
+
+# Integer-valued branches. TTree::Draw hands everything back as doubles.
+intBranches = {"OP_productionFiber": np.int64, "OP_isCoreC": np.int64}
+
+# Bytes of one photon row of the columns, i.e. what a photon cut before reading does not materialize
+photonBytes = 8*len(opBranches)
+
+class PhotonSelection:
+    """
+    Photon cut on the raw OP_* branches: Cherenkov core photons only
+    (coreOnly), that reached the end of the fiber (zEnd > zEndMin) and arrive
+    in tMin < t < tMax. expression() is the same cut as a TTreeFormula, so
+    the reader applies it before any photon is materialized; mask() applies
+    it to arrays. Limits set to None are not cut on.
+    """
+    def __init__(self, coreOnly=True, zEndMin=0.0, tMin=0.0, tMax=40.0):
+        self.coreOnly = coreOnly
+        self.zEndMin = zEndMin
+        self.tMin, self.tMax = tMin, tMax
+
+    def expression(self):
+        cuts = []
+        if self.coreOnly: cuts.append("OP_isCoreC != 0")
+        if self.zEndMin is not None: cuts.append("OP_pos_final_z > {!r}".format(float(self.zEndMin)))
+        if self.tMin is not None: cuts.append("OP_time_final > {!r}".format(float(self.tMin)))
+        if self.tMax is not None: cuts.append("OP_time_final < {!r}".format(float(self.tMax)))
+        return " && ".join(cuts)
+
+    def mask(self, isCoreC, zEnd, t):
+        keep = np.ones(len(t), dtype=bool)
+        if self.coreOnly: keep &= np.asarray(isCoreC) != 0
+        if self.zEndMin is not None: keep &= np.asarray(zEnd) > self.zEndMin
+        if self.tMin is not None: keep &= np.asarray(t) > self.tMin
+        if self.tMax is not None: keep &= np.asarray(t) < self.tMax
+        return keep
+
+def pruneBranches(tree, branches=opBranches):
+    # Only the given branches are read from disk from now on
+    tree.SetBranchStatus("*", 0)
+    for name in branches:
+        tree.SetBranchStatus(name, 1)
+
+def branchBytes(tree, branches=opBranches):
+    """
+    Compressed bytes on disk of the given branches and of the whole tree,
+    i.e. what a pruned and an unpruned read of all entries load.
+    """
+    kept = sum(tree.GetBranch(name).GetZipBytes("*") for name in branches)
+    return kept, tree.GetZipBytes()
+
+def bufferToArray(buf, n):
+    """
+    Copy the first n values of a TTree::Draw double buffer into a NumPy array.
+    The buffer is reused by the next Draw call, so a copy is required.
+    """
+    if n == 0:
+        return np.empty(0)
+    buf.reshape((n,))
+    return np.array(buf, dtype=np.float64, copy=True)
+
+class EventView:
+    """
+    One event of an EventChunk. It exposes the same OP_* attributes as a
+    PyROOT tree event, as slices of the chunk columns, so Photons(event)
+    works on either.
+    """
+    def __init__(self, chunk, i):
+        lo, hi = chunk.offsets[i], chunk.offsets[i+1]
+        for name, col in chunk.columns.items():
+            setattr(self, name, col[lo:hi])
+        self.entry = chunk.firstEntry + i
+        # Photons in the tree entry, before any selection in the reader
+        self.nAll = int(chunk.allCounts[i] if chunk.allCounts is not None else hi - lo)
+
+class EventChunk:
+    """
+    A contiguous entry range of the tree stored as flat columns.
+    Photons of event i live in columns[name][offsets[i]:offsets[i+1]].
+    If the photons were selected on reading, allCounts holds the number of
+    photons of each entry before the selection.
+    """
+    def __init__(self, firstEntry, offsets, columns, allCounts=None):
+        self.firstEntry = firstEntry
+        self.offsets = offsets
+        self.columns = columns
+        self.allCounts = allCounts
+
+    def nEvents(self):
+        return len(self.offsets) - 1
+
+    def nPhotons(self):
+        return int(self.offsets[-1])
+
+    def event(self, i):
+        return EventView(self, i)
+
+    def __iter__(self):
+        for i in range(self.nEvents()):
+            yield self.event(i)
+
+def readChunk(tree, first, nEntries, branches=opBranches, selection=None):
+    """
+    Read entries [first, first+nEntries) of the tree into an EventChunk.
+    Both passes run in C++ through TTree::Draw, so no per-event PyROOT
+    proxies are created. With a PhotonSelection only the photons passing it
+    are read into the columns.
+    """
+    cut = selection.expression() if selection is not None else ""
+    # Draw may book an htemp histogram; keep it out of the output file
+    with stats.stage("tree read") as timing, ROOT.TDirectory.TContext(ROOT.gROOT):
+        # First pass: photons per event, all and selected, which sizes the second pass and gives the offsets
+        tree.SetEstimate(nEntries + 1)
+        length = "Length$({})".format(branches[0])
+        nRead = tree.Draw(length + (":Sum$(({}))".format(cut) if cut else ""), "", "goff", nEntries, first)
+        allCounts = bufferToArray(tree.GetV1(), nRead).astype(np.int64)
+        counts = bufferToArray(tree.GetV2(), nRead).astype(np.int64) if cut else allCounts
+        offsets = np.zeros(nRead + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # Second pass: the photon columns of the selected photons, flattened over events
+        nTotal = int(offsets[-1])
+        tree.SetEstimate(nTotal + 1)
+        nRows = tree.Draw(":".join(branches), cut, "goff", nEntries, first) if nTotal > 0 else 0
+        timing.items = nRows
+    if nRows != nTotal:
+        raise RuntimeError("Expected {} photons in entries {}-{}, read {}".format(nTotal, first, first + nRead, nRows))
+    stats.count("photons in tree", int(allCounts.sum()))
+    stats.count("photons read", nRows)
+
+    columns = {}
+    for i, name in enumerate(branches):
+        col = bufferToArray(tree.GetVal(i), nRows)
+        columns[name] = col.astype(intBranches[name]) if name in intBranches else col
+    return EventChunk(first, offsets, columns, allCounts if cut else None)
+
+def iterChunks(tree, chunkSize=100, first=0, last=None, selection=None):
+    """
+    Stream the entry range [first, last) of the tree as EventChunks of at
+    most chunkSize events. Only the OP_* branches are read.
+    """
+    if last is None or last > tree.GetEntries():
+        last = tree.GetEntries()
+    pruneBranches(tree)
+    for start in range(first, last, chunkSize):
+        yield readChunk(tree, start, min(chunkSize, last - start), selection=selection)
+
+def iterEvents(tree, chunkSize=100, first=0, last=None, selection=None):
+    """
+    Drop-in replacement for 'for event in tree' that reads chunkSize events
+    at a time behind the scenes.
+    """
+    for chunk in iterChunks(tree, chunkSize, first, last, selection):
+        yield from chunk
+
+def enableThreadedReads():
+    # A reader thread next to the main one: ROOT's global state must be locked, and
+    # TTree::Draw has to let go of the GIL for the two threads to actually overlap
+    ROOT.EnableThreadSafety()
+    ROOT.TTree.Draw.__release_gil__ = True
+
+class Prefetcher:
+    """
+    Runs an iterator, e.g. iterChunks, in a background thread up to depth
+    items ahead of the consumer, so the next chunk is read and converted
+    while the current one is processed. The queue is bounded: once depth
+    items are waiting the reader blocks, which caps the read-ahead memory.
+    Keeps the time the reader spent reading and blocked on a full queue,
+    and the time the consumer stalled on an empty one.
+    """
+    def __init__(self, source, depth=2):
+        self.source = source
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+        self.items = 0
+        self.readSeconds = 0.0
+        self.blockedSeconds = 0.0
+        self.stallSeconds = 0.0
+
+    def put(self, kind, value=None):
+        # Wait for room in the queue unless the consumer is gone
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.queue.put((kind, value), timeout=0.1)
+                self.blockedSeconds += time.perf_counter() - start
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            items = iter(self.source)
+            while True:
+                start = time.perf_counter()
+                item = next(items, self)
+                self.readSeconds += time.perf_counter() - start
+                if item is self or not self.put("item", item):
+                    break
+        except BaseException as e:
+            self.put("error", e)
+            return
+        self.put("done")
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                kind, value = self.queue.get()
+                self.stallSeconds += time.perf_counter() - start
+                if kind == "error":
+                    raise value
+                if kind == "done":
+                    return
+                self.items += 1
+                yield value
+        finally:
+            self.stop.set()
+            self.thread.join()
+            if stats.enabled:
+                stats.add("prefetch stall", self.stallSeconds, self.items)
+                stats.add("prefetch blocked", self.blockedSeconds, self.items)
+
+    def summary(self):
+        return "Prefetch (depth {}): {} chunks read in {:.1f} s, reader blocked {:.1f} s on a full queue, processing stalled {:.1f} s waiting for data".format(
+            self.depth, self.items, self.readSeconds, self.blockedSeconds, self.stallSeconds)
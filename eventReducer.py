@@ -0,0 +1,146 @@
+import argparse
+import numpy as np
+import ROOT
+
+from histTools import histArray
+from mergeOutputs import detach, histNames
+
+# Per-event counts are binned in these levels for the quantiles: exact up to 8, then coarser
+levelEdges = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 16, 20, 24, 32, 48, 64, 96, 128, 192, 256, 512, 1024, 2048, 1 << 31])
+nLevels = len(levelEdges) - 1
+
+# Histograms an EventReducer is written as, next to the one-bin-events histogram it belongs to
+accumulatorSuffixes = ("_evN", "_evSum", "_evSum2", "_evLevels")
+
+def isAccumulator(name):
+    return name.endswith(accumulatorSuffixes)
+
+class EventReducer:
+    """
+    Event-to-event statistics of a per-event 2D distribution, e.g. the (r,t)
+    map of one event, without an events axis. Per bin it keeps the number of
+    events, the sum and the sum of squares of the per-event counts and,
+    optionally, how many events fell in each count level (for quantiles).
+    Memory does not depend on the number of events, and every accumulator
+    is additive, so outputs of several jobs or checkpoints still just add up.
+    """
+    def __init__(self, name, title, xAxis, yAxis, quantiles=False):
+        self.name, self.title = name, title
+        self.xAxis, self.yAxis = xAxis, yAxis
+        self.ncells = (xAxis[0] + 2)*(yAxis[0] + 2)
+        self.quantiles = quantiles
+        self.reset()
+
+    def reset(self):
+        self.nEvents = 0
+        self.sum = np.zeros(self.ncells)
+        self.sum2 = np.zeros(self.ncells)
+        self.levels = np.zeros((self.ncells, nLevels), dtype=np.uint32) if self.quantiles else None
+
+    def add(self, bins):
+        """
+        One event, given the 2D global bin of each of its entries. Bins
+        without entries count as zero for this event and are not touched.
+        """
+        self.nEvents += 1
+        cells, counts = np.unique(bins, return_counts=True)
+        self.sum[cells] += counts
+        self.sum2[cells] += counts.astype(np.float64)**2
+        if self.levels is not None:
+            self.levels[cells, np.searchsorted(levelEdges, counts, side="right") - 1] += 1
+
+    def nbytes(self):
+        return self.sum.nbytes + self.sum2.nbytes + (self.levels.nbytes if self.levels is not None else 0)
+
+    def toHists(self, name=None):
+        # The accumulators as histograms: <name>_evN, _evSum, _evSum2 and, with quantiles, _evLevels
+        name = name or self.name
+        hN = ROOT.TH1D(name + "_evN", "events; ; events", 1, 0, 1)
+        hN.SetBinContent(1, self.nEvents)
+        hists = [hN]
+        for suffix, vals in (("_evSum", self.sum), ("_evSum2", self.sum2)):
+            h = ROOT.TH2D(name + suffix, self.title, *(self.xAxis + self.yAxis))
+            histArray(h)[:] = vals
+            h.SetEntries(self.nEvents)
+            hists.append(h)
+        if self.levels is not None:
+            h = ROOT.TH3D(name + "_evLevels", self.title + "; count level", *(self.xAxis + self.yAxis + (nLevels, 0, nLevels)))
+            # TH3 cells are x fastest, then y, then level
+            cells = histArray(h).reshape(nLevels + 2, self.ncells)
+            cells[1:-1] = self.levels.T
+            h.SetEntries(self.nEvents)
+            hists.append(h)
+        for h in hists: h.SetDirectory(ROOT.nullptr)
+        return hists
+
+def quantileFromLevels(levels, nEvents, q):
+    """
+    q-quantile of the per-event count of every bin from its level counts.
+    Events without entries in a bin are the level-0 events not stored.
+    Exact for counts up to 8, interpolated inside the wider levels.
+    """
+    levels = levels.astype(np.float64)
+    levels[:, 0] += nEvents - levels.sum(axis=1)
+    cum = np.cumsum(levels, axis=1)
+    target = q*nEvents
+    level = np.minimum((cum < target).sum(axis=1), nLevels - 1)
+    rows = np.arange(len(level))
+    before = cum[rows, level] - levels[rows, level]
+    frac = np.where(levels[rows, level] > 0, (target - before)/np.maximum(levels[rows, level], 1), 0.0)
+    width = np.diff(levelEdges)[level]
+    # Integer counts: a level [a, b) holds a, ..., b-1; the open last level gives its lower edge
+    spread = np.where(level == nLevels - 1, 0, width - 1)
+    return levelEdges[level] + np.clip(frac, 0.0, 1.0)*spread
+
+def summarize(f, name, quantiles=(0.16, 0.5, 0.84)):
+    """
+    Mean, RMS, fluctuation (RMS/mean) and quantiles across events of the
+    per-event counts of the reduced histogram name in the open file f, as
+    TH2Ds named <name>_mean, _rms, _fluct and _qNN.
+    """
+    nEvents = f.Get(name + "_evN").GetBinContent(1)
+    hSum, hSum2 = detach(f.Get(name + "_evSum")), detach(f.Get(name + "_evSum2"))
+    mean = histArray(hSum)/max(nEvents, 1)
+    rms = np.sqrt(np.clip(histArray(hSum2)/max(nEvents, 1) - mean*mean, 0.0, None))
+    fluct = np.divide(rms, mean, out=np.zeros_like(rms), where=mean > 0)
+
+    out = {}
+    for suffix, vals in (("_mean", mean), ("_rms", rms), ("_fluct", fluct)):
+        h = hSum.Clone(name + suffix)
+        h.Reset()
+        histArray(h)[:] = vals
+        h.SetEntries(nEvents)
+        out[name + suffix] = h
+
+    hLevels = f.Get(name + "_evLevels")
+    if hLevels and quantiles:
+        ncells = histArray(hSum).size
+        levels = histArray(hLevels).reshape(nLevels + 2, ncells)[1:-1].T
+        for q in quantiles:
+            h = hSum.Clone("{}_q{:02d}".format(name, int(round(100*q))))
+            h.Reset()
+            histArray(h)[:] = quantileFromLevels(levels, nEvents, q)
+            h.SetEntries(nEvents)
+            out[h.GetName()] = h
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Event-to-event statistics of the reduced rte/rze/tze maps of a simSPADs output")
+    parser.add_argument("input_file", nargs="?", default="outfile.root", help="simSPADs output run with --event-axis reduce")
+    parser.add_argument("-o", "--output", default="eventStats.root", help="Output file")
+    parser.add_argument("--quantiles", type=lambda spec: [float(q) for q in spec.split(",")], default=[0.16, 0.5, 0.84], help="Comma separated quantiles")
+    args = parser.parse_args()
+
+    f = ROOT.TFile.Open(args.input_file, "READ")
+    names = [n[:-len("_evN")] for n in histNames(f) if n.endswith("_evN")]
+    out = ROOT.TFile(args.output, "RECREATE")
+    for name in names:
+        for h in summarize(f, name, args.quantiles).values():
+            out.cd()
+            h.Write()
+    out.Close()
+    f.Close()
+    print("Wrote event statistics of {} histograms to {}".format(len(names), args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import numpy as np
+import ROOT
+
+from pixelEngine import axisBin
+from histTools import histArray, sumw2Array
+
+# ROOT class and number of fill statistics (see TH1::GetStats) per dimension
+histClasses = {1: "TH1D", 2: "TH2D", 3: "TH3D"}
+nStats = {1: 4, 2: 7, 3: 11}
+
+class CountHist:
+    """
+    Unit-weight counts of a TH1D/TH2D/TH3D in a flat integer array, one entry
+    per cell with under/overflow, plus the fill statistics ROOT would keep.
+    Fills take whole arrays at once. The ROOT histogram, Sumw2 included, is
+    only built by toHist at write time.
+    """
+    def __init__(self, name, title, *axes, dtype=np.uint32):
+        # axes: (nBins, lo, hi) for each dimension
+        self.name, self.title = name, title
+        self.axes = axes
+        self.dtype = dtype
+        self.ncells = int(np.prod([n + 2 for n, _, _ in axes]))
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(self.ncells, dtype=self.dtype)
+        self.stats = np.zeros(nStats[len(self.axes)])
+        self.entries = 0
+
+    def bins(self, *coords):
+        """
+        Global bin (as TH1::FindBin) and in-range mask of every point. Can be
+        computed once and passed to fillBins of several histograms.
+        """
+        gbin, stride, inRange = 0, 1, True
+        for (n, lo, hi), x in zip(self.axes, coords):
+            b = axisBin(x, n, lo, hi)
+            gbin = gbin + stride*b
+            inRange = inRange & (b >= 1) & (b <= n)
+            stride *= n + 2
+        return gbin, inRange
+
+    def fill(self, *coords, counts=None):
+        coords = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in coords))
+        self.fillBins(*self.bins(*coords), *coords, counts=counts)
+
+    def fillBins(self, gbin, inRange, *coords, counts=None):
+        """
+        Add one entry per point, or counts[k] entries for point k, which is
+        the same as that many unit-weight Fill calls.
+        """
+        mult = np.ones(len(gbin), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.entries += int(mult.sum())
+        self.updateStats([np.asarray(x)[inRange] for x in coords], mult[inRange])
+        if len(gbin) > self.ncells >> 3:
+            self.counts += np.bincount(gbin, weights=counts, minlength=self.ncells).astype(self.dtype)
+        else:
+            cells, inverse = np.unique(gbin, return_inverse=True)
+            self.counts[cells] += np.bincount(inverse.ravel(), weights=counts, minlength=len(cells)).astype(self.dtype)
+
+    def updateStats(self, xs, w):
+        # Running sums of TH1/TH2/TH3::Fill for in-range entries, in ROOT's order
+        x = xs[0]
+        s = [w.sum(), w.sum(), (w*x).sum(), (w*x*x).sum()]
+        if len(xs) > 1:
+            y = xs[1]
+            s += [(w*y).sum(), (w*y*y).sum(), (w*x*y).sum()]
+        if len(xs) > 2:
+            z = xs[2]
+            s += [(w*z).sum(), (w*z*z).sum(), (w*x*z).sum(), (w*y*z).sum()]
+        self.stats += s
+
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def delta(self):
+        # Everything filled since the last reset, compact: occupied cells only (see pixelMaps.saveDeltas)
+        bins = np.flatnonzero(self.counts)
+        return {"bins": bins, "counts": self.counts[bins], "stats": self.stats, "entries": np.array(self.entries)}
+
+    def addDelta(self, bins, counts, stats, entries):
+        self.counts[np.asarray(bins, dtype=np.int64)] += np.asarray(counts).astype(self.dtype)
+        self.stats += stats
+        self.entries += int(entries)
+
+    def toHist(self, name=None):
+        """
+        The ROOT histogram these counts stand for, with the same contents,
+        Sumw2, entries and statistics per-entry Fill calls would give.
+        """
+        name = name or self.name
+        args = [a for axis in self.axes for a in axis]
+        h = getattr(ROOT, histClasses[len(self.axes)])(name, self.title, *args)
+        h.SetDirectory(ROOT.nullptr)
+        cells = np.flatnonzero(self.counts)
+        histArray(h)[cells] = self.counts[cells]
+        sumw2Array(h)[cells] = self.counts[cells]
+        h.PutStats(self.stats)
+        h.SetEntries(self.entries)
+        return h
+
+class HistBook(dict):
+    """
+    Histograms of a run by name: CountHists for the unit-weight families and
+    plain ROOT histograms for weighted ones. Names that always get the same
+    fills can share one CountHist (alias) and are still written separately.
+    Accumulators that stand for several histograms, such as an
+    EventReducer, provide toHists.
+    handles() gives the per-pitch histograms of a family once, so the fill
+    loops do not format names.
+    """
+    def __init__(self):
+        super().__init__()
+        self.cache = {}
+
+    def book(self, name, h):
+        self[name] = h
+        return h
+
+    def alias(self, name, target):
+        self[name] = self[target]
+
+    def handles(self, pattern, nChannels):
+        key = (pattern, tuple(c.name for c in nChannels))
+        if key not in self.cache:
+            self.cache[key] = [self[pattern.format(c.name)] for c in nChannels]
+        return self.cache[key]
+
+    def reset(self):
+        for h in {id(h): h for h in self.values()}.values():
+            h.reset() if hasattr(h, "reset") else h.Reset()
+
+    def toHists(self, name):
+        # ROOT histograms to write for name: a ROOT histogram is written as it is
+        h = self[name]
+        if isinstance(h, CountHist):
+            return [h.toHist(name)]
+        if hasattr(h, "toHists"):
+            return h.toHists(name[:-len("_ev")] if name.endswith("_ev") else name)
+        return [h]
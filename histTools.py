@@ -0,0 +1,23 @@
+import numpy as np
+
+def histArray(h, ncells=None):
+    """
+    Writable NumPy view of the bin contents of a TH1/TH2/TH3 (or of a TArrayD),
+    including under/overflow cells.
+    """
+    buf = h.GetArray()
+    buf.reshape((h.GetNcells() if ncells is None else ncells,))
+    return np.frombuffer(buf, dtype=np.float64)
+
+def hist2DArray(h):
+    """
+    Bin contents of a TH2 as an (nY+2, nX+2) view, under/overflow included,
+    so arr[iy, ix] is GetBinContent(ix, iy).
+    """
+    return histArray(h).reshape(h.GetNbinsY() + 2, h.GetNbinsX() + 2)
+
+def sumw2Array(h):
+    # Same as histArray for the Sumw2 array, which is created if missing
+    if not h.GetSumw2N():
+        h.Sumw2()
+    return histArray(h.GetSumw2(), h.GetNcells())
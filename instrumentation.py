@@ -0,0 +1,108 @@
+import json
+import os
+import resource
+import time
+
+class Stage:
+    """
+    Times one pass through a stage. Set .items inside the with-block when
+    the number of items is only known after the work is done.
+    """
+    def __init__(self, stats, name, items):
+        self.stats = stats
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+class NoStage:
+    # Stand-in used while instrumentation is off: no clock reads, no bookkeeping
+    items = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+noStage = NoStage()
+
+class RunStats:
+    """
+    Cumulative wall time, call count and items processed per stage, plus
+    free-form counters. Disabled by default, in which case stage() hands out
+    a shared do-nothing context manager.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.peakRSSMB = 0.0
+        self.startTime = time.time()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def stage(self, name, items=0):
+        if not self.enabled:
+            return noStage
+        return Stage(self, name, items)
+
+    def add(self, name, seconds, items=0, calls=1):
+        s = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+        s["seconds"] += seconds
+        s["calls"] += calls
+        s["items"] += items
+
+    def count(self, name, n=1):
+        # NumPy scalars are stored as Python numbers, so the report stays JSON
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + (n.item() if hasattr(n, "item") else n)
+
+    def snapshot(self):
+        return {
+            "wallSeconds": time.time() - self.startTime,
+            "peakRSSMB": max(self.peakRSSMB, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    def merge(self, snap):
+        # Fold in the snapshot of another process, e.g. a pool worker
+        for name, s in snap["stages"].items():
+            self.add(name, s["seconds"], s["items"], s["calls"])
+        for name, n in snap["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.peakRSSMB = max(self.peakRSSMB, snap["peakRSSMB"])
+
+def plainNumber(x):
+    # json.dump fallback for NumPy scalars and arrays
+    if hasattr(x, "tolist"):
+        return x.tolist()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(x).__name__))
+
+def writeReport(path, snap, **info):
+    """
+    Write a run report as JSON. Each stage also gets its share of the total
+    stage time and its throughput in items/s.
+    """
+    total = sum(s["seconds"] for s in snap["stages"].values())
+    for s in snap["stages"].values():
+        s["fraction"] = s["seconds"]/total if total > 0 else 0.0
+        s["itemsPerSecond"] = s["items"]/s["seconds"] if s["seconds"] > 0 else None
+    report = dict(info)
+    report.update(snap)
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=2, default=plainNumber)
+    os.replace(path + ".tmp", path)
+
+# Process-wide instance the simulation modules report to
+stats = RunStats()
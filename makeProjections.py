@@ -1,4 +1,15 @@
+import argparse
+import multiprocessing
+import numpy as np
 import ROOT
+from histTools import hist2DArray, sumw2Array
+from renderQueue import histJob, renderAll, saveJobs, defaultCachePath
+from eventReducer import isAccumulator
+
+try:
+    from scipy.special import betaincinv
+except ImportError:
+    betaincinv = None
 
 def doProjections(h3d, histType):
     base_name = h3d.GetName()
@@ -17,7 +28,34 @@ def doProjections(h3d, histType):
     hist_yz.SetName(base_name + "_projYZ")    
     return hist_xy, hist_xz, hist_yz
 
-def compute_2d_efficiency_manual(num_hist, den_hist, name="eff_hist"):
+def efficiency_interval(num, den, method, level=0.682689492137):
+    """
+    Lower and upper bounds of the efficiency interval for arrays of passed
+    (num) and total (den) counts, den > 0. method is "wilson" or
+    "clopper-pearson".
+    """
+    if method == "wilson":
+        z = ROOT.Math.normal_quantile(0.5 + 0.5*level, 1.0)
+        p = num/den
+        centre = (p + z*z/(2*den))/(1 + z*z/den)
+        half = z/(1 + z*z/den)*np.sqrt(p*(1 - p)/den + z*z/(4*den*den))
+        return centre - half, centre + half
+    if method == "clopper-pearson":
+        alpha = 0.5*(1.0 - level)
+        if betaincinv is None:
+            # No SciPy: ROOT's beta quantiles, once per distinct (num, den) pair rather than per bin
+            pairs, inverse = np.unique(np.stack([num, den]), axis=1, return_inverse=True)
+            lower = np.array([ROOT.Math.beta_quantile(alpha, n, d - n + 1) if n > 0 else 0.0 for n, d in pairs.T])
+            upper = np.array([ROOT.Math.beta_quantile(1.0 - alpha, n + 1, d - n) if n < d else 1.0 for n, d in pairs.T])
+            inverse = inverse.reshape(-1)
+            return lower[inverse], upper[inverse]
+        with np.errstate(invalid="ignore"):
+            lower = np.where(num > 0, betaincinv(num, den - num + 1, alpha), 0.0)
+            upper = np.where(num < den, betaincinv(num + 1, den - num, 1.0 - alpha), 1.0)
+        return lower, upper
+    raise ValueError("Unknown efficiency interval '{}'".format(method))
+
+def compute_2d_efficiency_manual(num_hist, den_hist, name="eff_hist", method="binomial"):
     if not (num_hist.GetNbinsX() == den_hist.GetNbinsX() and
             num_hist.GetNbinsY() == den_hist.GetNbinsY()):
         raise ValueError("Histograms must have the same binning.")
@@ -25,88 +63,113 @@ def compute_2d_efficiency_manual(num_hist, den_hist, name="eff_hist"):
     eff_hist = num_hist.Clone(name)
     eff_hist.Reset()
 
-    for ix in range(1, num_hist.GetNbinsX() + 1):
-        for iy in range(1, num_hist.GetNbinsY() + 1):
-            num = num_hist.GetBinContent(ix, iy)
-            den = den_hist.GetBinContent(ix, iy)
-
-            if den > 0:
-                eff = num / den
-                if num == 0: 
-                    eff = 0.001
-                eff_hist.SetBinContent(ix, iy, eff)
-                # binomial error
-                err = (eff * (1 - eff) / den)**0.5 if num > 0 else 0.0
-                eff_hist.SetBinError(ix, iy, err)
-            else:
-                eff_hist.SetBinContent(ix, iy, 0.0)
-                eff_hist.SetBinError(ix, iy, 0.0)
+    # All bin contents in one go; only the in-range bins get an efficiency
+    num = hist2DArray(num_hist)[1:-1, 1:-1]
+    den = hist2DArray(den_hist)[1:-1, 1:-1]
+    hasDen = den > 0
+
+    eff = np.zeros(num.shape)
+    eff[hasDen] = num[hasDen]/den[hasDen]
+    eff[hasDen & (num == 0)] = 0.001
+
+    err = np.zeros(num.shape)
+    if method == "binomial":
+        # binomial error
+        ok = hasDen & (num > 0)
+        err[ok] = np.sqrt(np.clip(eff[ok]*(1 - eff[ok])/den[ok], 0.0, None))
+    else:
+        # Symmetric error from the half width of the interval
+        lower, upper = efficiency_interval(num[hasDen], den[hasDen], method)
+        err[hasDen] = 0.5*(upper - lower)
+
+    # Write everything back in bulk
+    hist2DArray(eff_hist)[1:-1, 1:-1] = eff
+    sumw2Array(eff_hist).reshape(eff.shape[0] + 2, eff.shape[1] + 2)[1:-1, 1:-1] = err*err
+    eff_hist.SetEntries(eff.size)
 
     return eff_hist
 
-def makeEff(num, den, c):
-    if num == None:
-        return None
-    #eff = num.Clone(num.GetName()+"eff")
-    #eff.Divide(num, den, 1.0, 1.0, "B")  # Binomial errors
+def compute_2d_efficiencies(pairs, method="binomial"):
+    """
+    Efficiencies for a whole list of (num_hist, den_hist, name) in one call,
+    e.g. every pitch and hist type of a file.
+    """
+    return [compute_2d_efficiency_manual(num, den, name, method) for num, den, name in pairs]
+
+def effJob(eff, file_path):
+    # Efficiency maps are drawn on a fixed 0-1 scale
+    return histJob(file_path, eff.GetName(), "output/" + eff.GetName() + ".png", "COLZ", stats=0, maximum=1.0)
+
+def projJob(hist, file_path):
+    return histJob(file_path, hist.GetName(), "output/" + hist.GetName() + ".png", "COLZ", stats=0)
+
+def makePlots(input_filename, histTypes=("rte", "rze", "tze", "xyt"), method="binomial", out_filename="projections.root"):
+    """
+    Write the projections and efficiencies to out_filename and return the
+    queue of images to render from it. Nothing is drawn here.
+    """
+    ROOT.gROOT.SetBatch(True)
+    f = ROOT.TFile.Open(input_filename)
 
-    eff = compute_2d_efficiency_manual(num, den, num.GetName()+"eff")
+    out_file = ROOT.TFile(out_filename, "RECREATE")
 
-    eff.Write()
-    eff.SetStats(0)
-    eff.SetMaximum(1.0)
-    eff.Draw("COLZ")
-    c.SaveAs("output/" + eff.GetName() + ".png")  
-    return eff
+    # Make all 2D projections first, so the efficiencies of every pitch and hist type are done in one call
+    projections = []
+    pairs = []
+    for histType in histTypes:
+        histogram_suffix = "nPhotons_{}_all_".format(histType)
 
-def makePlots(input_filename, histType):
-    ROOT.gROOT.SetBatch(True)
-    f = ROOT.TFile.Open(input_filename)
-    histogram_suffix = "nPhotons_{}_all_".format(histType)
-
-    # Get list of keys and filter histograms
-    hist_names = [key.GetName() for key in f.GetListOfKeys()]
-    matching_hists = [name.replace(histogram_suffix,"") for name in hist_names if name.startswith(histogram_suffix)]
-
-    # Save and plot
-    c1 = ROOT.TCanvas( "c", "c", 800, 700)
-    ROOT.gStyle.SetOptFit(1)
-    ROOT.gPad.SetLeftMargin(0.12)
-    ROOT.gPad.SetRightMargin(0.15)
-    ROOT.gPad.SetTopMargin(0.08)
-    ROOT.gPad.SetBottomMargin(0.12)
-    ROOT.gPad.SetTicks(1,1)
-
-    out_file = ROOT.TFile("projections.root", "RECREATE")
-
-    for i, hist_name in enumerate(matching_hists):
-        histNum = f.Get("nPhotons_{}_oneHit_{}".format(histType, hist_name))
-        histDen = f.Get(   "nPhotons_{}_all_{}".format(histType, hist_name))
-
-        #Make 2D histograms
-        hNum_xy, hNum_xz, hNum_yz = doProjections(histNum, histType)
-        hDen_xy, hDen_xz, hDen_yz = doProjections(histDen, histType)
-
-        #Make eff histograms
-        eff_xy = makeEff(hNum_xy, hDen_xy, c1)
-        eff_xz = makeEff(hNum_xz, hDen_xz, c1)
-        eff_yz = makeEff(hNum_yz, hDen_yz, c1)
-
-        #Save things
-        for hist in [hNum_xy, hNum_xz, hNum_yz, hDen_xy, hDen_xz, hDen_yz]:
-            if hist == None: continue
-            hist.Write()
-            hist.SetStats(0)
-            hist.Draw("COLZ")
-            c1.SaveAs("output/" + hist.GetName() + ".png")
+        # Get list of keys and filter histograms; only the TH3 maps, not the --event-axis reduce accumulators
+        hist_names = [key.GetName() for key in f.GetListOfKeys() if key.GetClassName().startswith("TH3") and not isAccumulator(key.GetName())]
+        matching_hists = [name.replace(histogram_suffix,"") for name in hist_names if name.startswith(histogram_suffix)]
 
-    out_file.Close()
+        for i, hist_name in enumerate(matching_hists):
+            histNum = f.Get("nPhotons_{}_oneHit_{}".format(histType, hist_name))
+            histDen = f.Get(   "nPhotons_{}_all_{}".format(histType, hist_name))
+
+            #Make 2D histograms
+            hNums = doProjections(histNum, histType)
+            hDens = doProjections(histDen, histType)
+            pairs += [(hNum, hDen, hNum.GetName()+"eff") for hNum, hDen in zip(hNums, hDens) if hNum != None]
+            projections += [hist for hist in hNums + hDens if hist != None]
+
+    #Make eff histograms
+    jobs = []
+    out_file.cd()
+    for eff in compute_2d_efficiencies(pairs, method):
+        eff.Write()
+        jobs.append(effJob(eff, out_filename))
 
-def main(input_filename):
-    makePlots(input_filename, "rte")
-    makePlots(input_filename, "rze")
-    makePlots(input_filename, "tze")
-    makePlots(input_filename, "xyt")
+    #Save things
+    for hist in projections:
+        hist.Write()
+        jobs.append(projJob(hist, out_filename))
+
+    out_file.Close()
+    f.Close()
+    return jobs
+
+def main(input_filename, method="binomial", images="now", nJobs=1, queue_filename="projections_render.json", cachePath=defaultCachePath):
+    """
+    images is "now" (render right after writing), "later" (only save the
+    render queue, for renderQueue.py) or "none". Images that are up to date
+    in the render cache at cachePath are not redrawn.
+    """
+    jobs = makePlots(input_filename, ("rte", "rze", "tze", "xyt"), method)
+    if images == "none":
+        return
+    saveJobs(queue_filename, jobs)
+    if images == "now":
+        renderAll(jobs, nJobs, cachePath)
 
 if __name__ == "__main__":
-    main("outfile.root")
+    parser = argparse.ArgumentParser(description="Project the simSPADs maps and compute oneHit/all efficiencies")
+    # Path of the (merged) simSPADs output
+    parser.add_argument("input_file", nargs="?", default="outfile.root", help="simSPADs output file")
+    parser.add_argument("--interval", choices=["binomial", "wilson", "clopper-pearson"], default="binomial", help="Efficiency error: binomial, or half width of a Wilson or Clopper-Pearson interval")
+    parser.add_argument("--images", choices=["now", "later", "none"], default="now", help="Render the PNGs now, only queue them in --queue for renderQueue.py, or skip them")
+    parser.add_argument("--queue", default="projections_render.json", help="Render queue file")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="Number of rendering processes")
+    parser.add_argument("--no-cache", action="store_true", help="Redraw every image, even if it is up to date")
+    args = parser.parse_args()
+    main(args.input_file, args.interval, args.images, args.jobs, args.queue, None if args.no_cache else defaultCachePath)
@@ -0,0 +1,211 @@
+import os
+import glob
+import time
+import shutil
+import fnmatch
+import argparse
+import multiprocessing
+import ROOT
+
+# Histogram families of a simSPADs output. The nPhotons patterns include the
+# xyt/rte/rze/tze maps and the _ev* accumulators of --event-axis reduce.
+histFamilies = {
+    "nPhotons_all":       "nPhotons_*_all_*",
+    "nPhotons_oneHit":    "nPhotons_*_oneHit_*",
+    "nPhotonsPerChannel": "nPhotonsPerChannel_*",
+    "signal_time":        "signal_time_*",
+}
+
+def detach(h):
+    """
+    Take a histogram read from a file out of the file's directory and hand it
+    to Python, so it is freed as soon as it goes out of scope.
+    """
+    h.SetDirectory(ROOT.nullptr)
+    ROOT.SetOwnership(h, True)
+    return h
+
+def histNames(f):
+    # Unique key names, in file order (a key may have several cycles)
+    names = []
+    for key in f.GetListOfKeys():
+        if key.GetName() not in names:
+            names.append(key.GetName())
+    return names
+
+def family(name):
+    # Family of a histogram name, None for names simSPADs does not write
+    for fam, pattern in histFamilies.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return fam
+    return None
+
+def axisBinning(axis):
+    # Everything that has to agree for two axes to be added bin by bin
+    edges = tuple(axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)) if axis.IsVariableBinSize() else ()
+    return axis.GetNbins(), axis.GetXmin(), axis.GetXmax(), edges
+
+def binning(h):
+    axes = (h.GetXaxis(), h.GetYaxis(), h.GetZaxis())[:h.GetDimension()]
+    return h.ClassName(), tuple(axisBinning(a) for a in axes)
+
+def checkBinning(merged, h, name, path):
+    if binning(h) != binning(merged):
+        raise ValueError("Binning of {} in {} differs: {} instead of {}".format(name, path, binning(h), binning(merged)))
+
+def checkShards(inputPaths):
+    """
+    Check that all shards hold the same histograms, from the file keys
+    only. Returns the histogram names, in the order of the first shard.
+    """
+    names = None
+    for p in inputPaths:
+        f = ROOT.TFile.Open(p, "READ")
+        if not f or f.IsZombie():
+            raise IOError("Cannot open {}".format(p))
+        keys = {key.GetName(): key.GetClassName() for key in f.GetListOfKeys()}
+        order = histNames(f)
+        f.Close()
+        if names is None:
+            names, first, reference = order, p, keys
+        elif keys != reference:
+            missing = sorted(set(reference) - set(keys))
+            extra = sorted(set(keys) - set(reference))
+            changed = sorted(n for n in set(keys) & set(reference) if keys[n] != reference[n])
+            raise ValueError("{} does not match {}: missing {}, extra {}, other class {}".format(p, first, missing, extra, changed))
+    return names
+
+def mergeFiles(inputPaths, outputPath):
+    """
+    Add up the histograms of several simSPADs outputs into a single file with
+    the same layout. Inputs are merged one histogram at a time, in the order
+    given, so only one histogram family is held in memory. The binning of
+    every histogram is checked before it is added.
+    """
+    inputs = [ROOT.TFile.Open(p, "READ") for p in inputPaths]
+    out = ROOT.TFile(outputPath, "RECREATE")
+    for name in histNames(inputs[0]):
+        merged = detach(inputs[0].Get(name))
+        for p, f in zip(inputPaths[1:], inputs[1:]):
+            h = f.Get(name)
+            if not h:
+                raise ValueError("{} has no {}".format(p, name))
+            h = detach(h)
+            checkBinning(merged, h, name, p)
+            merged.Add(h)
+            del h
+        out.cd()
+        merged.Write(name)
+        del merged
+    out.Close()
+    for f in inputs:
+        f.Close()
+
+def combineFiles(inputPaths, outputPath):
+    """
+    Put the histograms of several files side by side in one file, e.g. an
+    output and the pitches added to it later. Histograms are copied one at a
+    time; a name found in more than one input is taken from the first.
+    """
+    inputs = [ROOT.TFile.Open(p, "READ") for p in inputPaths]
+    out = ROOT.TFile(outputPath, "RECREATE")
+    written = set()
+    for f in inputs:
+        for name in histNames(f):
+            if name in written: continue
+            h = detach(f.Get(name))
+            out.cd()
+            h.Write(name)
+            written.add(name)
+            del h
+    out.Close()
+    for f in inputs:
+        f.Close()
+
+def mergeGroup(task):
+    # Pool worker: one node of the merge tree
+    inputPaths, outputPath = task
+    mergeFiles(inputPaths, outputPath)
+    return outputPath
+
+def mergeTree(inputPaths, outputPath, nJobs=1, fanIn=2, tmpDir=None):
+    """
+    Add up many shards as a tree: every round merges groups of fanIn files
+    on a pool of nJobs processes, until at most fanIn files are left for
+    the final merge into outputPath. Each merge streams one histogram at a
+    time, so a worker holds at most two histograms. Intermediate files go
+    to tmpDir and are removed as soon as the next round is done with them.
+    """
+    fanIn = max(fanIn, 2)
+    tmpDir = tmpDir or outputPath + ".mergeTmp"
+    os.makedirs(tmpDir, exist_ok=True)
+    paths, level = list(inputPaths), 0
+    try:
+        while len(paths) > fanIn:
+            groups = [paths[i:i + fanIn] for i in range(0, len(paths), fanIn)]
+            nextPaths = [os.path.join(tmpDir, "level{}_{}.root".format(level, i)) if len(g) > 1 else g[0] for i, g in enumerate(groups)]
+            tasks = [(g, o) for g, o in zip(groups, nextPaths) if len(g) > 1]
+            if nJobs > 1 and len(tasks) > 1:
+                with multiprocessing.Pool(min(nJobs, len(tasks))) as pool:
+                    pool.map(mergeGroup, tasks)
+            else:
+                for task in tasks: mergeGroup(task)
+            # Intermediate files of the previous round are merged into this one's
+            for p in paths:
+                if p not in nextPaths and os.path.dirname(p) == tmpDir: os.remove(p)
+            paths, level = nextPaths, level + 1
+        mergeFiles(paths, outputPath)
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+def familySummary(path):
+    # Number of histograms and bytes on disk per family of an output
+    f = ROOT.TFile.Open(path, "READ")
+    summary = {}
+    for key in f.GetListOfKeys():
+        fam = family(key.GetName()) or "other"
+        n, nBytes = summary.get(fam, (0, 0))
+        summary[fam] = (n + 1, nBytes + key.GetNbytes())
+    f.Close()
+    return summary
+
+def expandShards(items):
+    # Paths, glob patterns or directories of shards
+    paths = []
+    for item in items:
+        if os.path.isdir(item):
+            paths += sorted(glob.glob(os.path.join(item, "*.root")))
+        elif glob.has_magic(item):
+            paths += sorted(glob.glob(item))
+        else:
+            paths.append(item)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Add up simSPADs output shards (e.g. jobs over files or entry ranges) into one output")
+    parser.add_argument("shards", nargs="+", help="simSPADs outputs: paths, glob patterns (quoted) or directories")
+    parser.add_argument("-o", "--output", default="outfile.root", help="Merged output file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes per round of the merge tree")
+    parser.add_argument("--fan-in", type=int, default=2, help="Shards added up by one merge")
+    args = parser.parse_args()
+
+    shards = expandShards(args.shards)
+    if not shards:
+        raise SystemExit("No shards to merge")
+    if os.path.abspath(args.output) in map(os.path.abspath, shards):
+        raise SystemExit("The output {} is one of the shards".format(args.output))
+
+    start = time.perf_counter()
+    names = checkShards(shards)
+    unknown = [n for n in names if family(n) is None]
+    if unknown:
+        print("⚠️ Warning: {} histograms outside the simSPADs families are added up as well, e.g. {}".format(len(unknown), unknown[0]))
+    mergeTree(shards, args.output + ".tmp", args.jobs, args.fan_in)
+    os.replace(args.output + ".tmp", args.output)
+
+    print("Merged {} shards into {} in {:.1f} s".format(len(shards), args.output, time.perf_counter() - start))
+    for fam, (n, nBytes) in familySummary(args.output).items():
+        print("  {:<20} {:>5} histograms {:>10.1f} MB".format(fam, n, nBytes/1024.0**2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import numpy as np
+
+# Random streams of an event, each with its own generator
+darkCountStream = 1
+electronicNoiseStream = 2
+deadTimeStream = 3
+
+def eventRng(seed, iEvent, stream):
+    """
+    Generator for one random stream of one event. It is seeded from (seed,
+    event, stream) only, so a run gives the same numbers however its events
+    are spread over workers and in whatever order they are processed.
+    """
+    return np.random.default_rng([seed, iEvent, stream])
+
+def electronicNoise(rng, shape, sigma):
+    # Gaussian noise for every sample of every waveform in a single draw
+    return rng.normal(0.0, sigma, shape)
+
+class DarkCounts:
+    """
+    Dark counts of the SPADs at rate [Hz/mm^2]: a Poisson number of counts
+    per event, uniform over the [lo, hi)^2 mm sensor and the [tLo, tHi) ns
+    window. The positions do not depend on the pitch, so one set of dark
+    counts serves every SiPM, each pixel getting rate x its area.
+    """
+    def __init__(self, rate, lo, hi, tLo, tHi, seed=0):
+        self.rate = rate
+        self.lo, self.hi = lo, hi
+        self.tLo, self.tHi = tLo, tHi
+        self.seed = seed
+
+    def mean(self):
+        return self.rate*1e-9*(self.tHi - self.tLo)*(self.hi - self.lo)**2
+
+    def generate(self, iEvent):
+        # x, y [mm] and t [ns] of the dark counts of one event
+        rng = eventRng(self.seed, iEvent, darkCountStream)
+        n = rng.poisson(self.mean())
+        return rng.uniform(self.lo, self.hi, n), rng.uniform(self.lo, self.hi, n), rng.uniform(self.tLo, self.tHi, n)
+
+def addDarkCounts(dark, iEvent, xs, ys, zs, ts, ws):
+    """
+    Merge the dark counts of an event into its hit list, keeping arrival
+    order. Dark counts have unit weight and no z. Returns the merged arrays
+    and a mask of the dark counts.
+    """
+    dx, dy, dt = dark.generate(iEvent)
+    order = np.argsort(np.concatenate((ts, dt)), kind="stable")
+    isDark = np.concatenate((np.zeros(len(ts), dtype=bool), np.ones(len(dt), dtype=bool)))[order]
+    merged = [np.concatenate(pair)[order] for pair in ((xs, dx), (ys, dy), (zs, np.full(len(dt), np.nan)), (ts, dt), (ws, np.ones(len(dt))))]
+    return merged + [isDark]
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from instrumentation import stats
+
+# One raw little-endian file per column, read back with np.memmap
+photonColumns = {"x": "<f8", "y": "<f8", "z": "<f8", "t": "<f8", "fiber": "<i4"}
+eventColumns = {"offsets": "<i8", "nPhotons": "<i8"}
+
+def fileIdentity(path, uuid=None):
+    """
+    Cheap identity of an input file: size and modification time, plus the
+    TFile UUID, which is new for every file ROOT writes. Nothing beyond the
+    file header is read, so computing it costs no I/O worth mentioning.
+    """
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns, "uuid": uuid}
+
+def cacheKey(input_file_path, first, last, calibration, uuid=None):
+    """
+    Key of the cached photons of entries [first, last) of an input file. It
+    changes with the file (see fileIdentity) and with the calibration tables
+    (fiber shifts, shrink rules, selection), so a stale cache is never
+    picked up.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps({"file": fileIdentity(input_file_path, uuid), "first": first, "last": last, "calibration": calibration}, sort_keys=True).encode())
+    return h.hexdigest()
+
+class PhotonCacheWriter:
+    """
+    Builds a cache entry one event at a time. Columns are appended to files
+    in a temporary directory that is moved into place by close(), so an
+    interrupted run never leaves a half-written entry behind.
+    """
+    def __init__(self, cacheDir, key, first, info=None):
+        self.path = os.path.join(cacheDir, key)
+        self.tmpPath = self.path + ".tmp"
+        shutil.rmtree(self.tmpPath, ignore_errors=True)
+        os.makedirs(self.tmpPath)
+        self.first = first
+        self.info = info or {}
+        self.files = {name: open(os.path.join(self.tmpPath, name + ".bin"), "wb") for name in photonColumns}
+        self.offsets = [0]
+        self.nPhotons = []
+
+    def append(self, nPhotons, x, y, z, t, fiber):
+        # Selected, transformed photons of the next event
+        with stats.stage("cache write", len(x)):
+            for name, vals in (("x", x), ("y", y), ("z", z), ("t", t), ("fiber", fiber)):
+                self.files[name].write(np.ascontiguousarray(vals, dtype=photonColumns[name]).tobytes())
+            self.offsets.append(self.offsets[-1] + len(x))
+            self.nPhotons.append(nPhotons)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for name, vals in (("offsets", self.offsets), ("nPhotons", self.nPhotons)):
+            np.asarray(vals, dtype=eventColumns[name]).tofile(os.path.join(self.tmpPath, name + ".bin"))
+        meta = dict(self.info)
+        meta.update({"first": self.first, "nEvents": len(self.nPhotons), "nSelected": self.offsets[-1],
+                     "columns": dict(photonColumns, **eventColumns)})
+        with open(os.path.join(self.tmpPath, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmpPath, self.path)
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmpPath, ignore_errors=True)
+
+class CachedEvent:
+    # Zero-copy slices of the cache columns for one event
+    def __init__(self, cache, i):
+        lo, hi = cache.offsets[i], cache.offsets[i+1]
+        self.entry = cache.first + i
+        self.nPhotons = int(cache.nPhotons[i])
+        self.x = cache.x[lo:hi]
+        self.y = cache.y[lo:hi]
+        self.z = cache.z[lo:hi]
+        self.t = cache.t[lo:hi]
+        self.fiber = cache.fiber[lo:hi]
+
+class PhotonCache:
+    """
+    Read side of a cache entry. Every column is memory mapped, so opening is
+    instant and the pages of an event are only read when it is used.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.first = self.meta["first"]
+        for name, dtype in self.meta["columns"].items():
+            colPath = os.path.join(path, name + ".bin")
+            # np.memmap refuses empty files
+            col = np.memmap(colPath, dtype=dtype, mode="r") if os.path.getsize(colPath) else np.zeros(0, dtype=dtype)
+            setattr(self, name, col)
+
+    def nEvents(self):
+        return self.meta["nEvents"]
+
+    def event(self, i):
+        return CachedEvent(self, i)
+
+    def iterEvents(self, first=None, last=None):
+        # Events of tree entries [first, last), by default all of them
+        lo = 0 if first is None else first - self.first
+        hi = self.nEvents() if last is None else last - self.first
+        for i in range(lo, hi):
+            with stats.stage("cache read", int(self.offsets[i+1] - self.offsets[i])):
+                event = self.event(i)
+            yield event
+
+def openCache(cacheDir, key):
+    # The cache entry for key, or None if it has not been built yet
+    path = os.path.join(cacheDir, key)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return PhotonCache(path)
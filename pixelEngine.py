@@ -0,0 +1,154 @@
+import numpy as np
+
+from noise import eventRng, deadTimeStream
+
+def axisBin(vals, nBins, lo, hi):
+    """
+    Array version of TAxis::FindFixBin for a fixed-width axis:
+    0 is underflow, nBins+1 is overflow. nBins, lo and hi broadcast against
+    vals, so an (nPitches, 1) nBins gives one row of bins per pitch.
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    inRange = (vals >= lo) & (vals < hi)
+    bins = 1 + np.where(inRange, nBins*(vals - lo)/(hi - lo), 0.0).astype(np.int64)
+    return np.where(vals < lo, 0, np.where(inRange, bins, nBins + 1))
+
+def pixelIndex(u, v, nBins, lo, hi):
+    """
+    Global bin number of (u, v) in a square nBins x nBins TH2D spanning
+    [lo, hi) on both axes, i.e. what TH2D::FindBin(u, v) returns.
+    Under/overflow bins are kept, so they act as pixels too, as in ROOT.
+    """
+    return axisBin(u, nBins, lo, hi) + (nBins + 2)*axisBin(v, nBins, lo, hi)
+
+def pixelMatrix(u, v, nBins, lo, hi):
+    """
+    Pixel indices of every photon for every pitch in one call: returns an
+    (nPitches, nPhotons) matrix whose row k is pixelIndex(u, v, nBins[k], lo, hi).
+    lo and hi may also be per-pitch sequences.
+    """
+    nBins = np.asarray(nBins, dtype=np.int64)[:, None]
+    lo, hi = (np.asarray(a)[:, None] if np.ndim(a) else a for a in (lo, hi))
+    return pixelIndex(u, v, nBins, lo, hi)
+
+def firstHitMask(pixels):
+    """
+    Given the pixel index of each photon in arrival-time order, return a
+    mask that is True for the first photon to reach each pixel. This is the
+    oneHit (dead SPAD) selection and costs O(nPhotons log nPhotons)
+    regardless of how many pixels the sensor has. A pixelMatrix is handled
+    row by row in a single pass.
+    """
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        # Give every pitch its own range of pixel numbers and reduce them together
+        rowOffset = (pixels.max(initial=0) + 1)*np.arange(pixels.shape[0], dtype=np.int64)[:, None]
+        return firstHitMask((pixels + rowOffset).ravel()).reshape(pixels.shape)
+    mask = np.zeros(len(pixels), dtype=bool)
+    # np.unique sorts stably when return_index is set, so these are first occurrences
+    _, first = np.unique(pixels, return_index=True)
+    mask[first] = True
+    return mask
+
+def channelOccupancy(pixels, nBins):
+    """
+    Photons-per-channel distribution over the nBins x nBins sensor, built
+    from the fired pixels only. Returns (nPhotons, nChannels) where
+    nChannels[k] channels saw nPhotons[k] photons; empty channels are
+    counted as nBins^2 minus the occupied ones. Under/overflow pixels are
+    not channels and are skipped.
+    """
+    bx, by = pixels % (nBins + 2), pixels // (nBins + 2)
+    inRange = (bx >= 1) & (bx <= nBins) & (by >= 1) & (by <= nBins)
+    _, perChannel = np.unique(pixels[inRange], return_counts=True)
+    nPhotons, nChannels = np.unique(perChannel, return_counts=True)
+    nEmpty = nBins*nBins - len(perChannel)
+    if nEmpty > 0:
+        nPhotons = np.concatenate(([0], nPhotons))
+        nChannels = np.concatenate(([nEmpty], nChannels))
+    return nPhotons, nChannels
+
+def deadTimeMask(pixels, ts, tauDead, tauRecovery=0.0, rng=None):
+    """
+    Photons that fire their SPAD when a fired SPAD is blind for tauDead and
+    then recovers. With tauRecovery > 0 a photon arriving dt after the last
+    firing is detected with probability 1 - exp(-(dt - tauDead)/tauRecovery)
+    (one rng draw per photon); otherwise the SPAD is fully efficient again
+    right after tauDead. tauDead = inf is the firstHitMask selection.
+
+    Photons are lexsorted by (pixel, t) and all pixels are advanced together,
+    one candidate photon per pixel per round, so the number of rounds is set
+    by the busiest pixel and not by the number of photons. A pixelMatrix is
+    handled as in firstHitMask.
+    """
+    pixels, ts = np.asarray(pixels), np.asarray(ts, dtype=np.float64)
+    if pixels.ndim == 2:
+        rowOffset = (pixels.max(initial=0) + 1)*np.arange(pixels.shape[0], dtype=np.int64)[:, None]
+        rowTimes = np.broadcast_to(ts, pixels.shape).ravel()
+        return deadTimeMask((pixels + rowOffset).ravel(), rowTimes, tauDead, tauRecovery, rng).reshape(pixels.shape)
+
+    n = len(pixels)
+    mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mask
+    order = np.lexsort((ts, pixels))
+    p, t = pixels[order], ts[order]
+    u = rng.random(n) if tauRecovery > 0 else None
+
+    # Groups of photons per pixel, and an exact integer (pixel, time) sort key for searching within them
+    newGroup = np.concatenate(([True], p[1:] != p[:-1]))
+    starts = np.flatnonzero(newGroup)
+    ends = np.append(starts[1:], n)
+    times, tRank = np.unique(t, return_inverse=True)
+    stride = len(times) + 1
+    key = (np.cumsum(newGroup) - 1)*stride + tRank.ravel()
+
+    def nextCandidate(g, last):
+        # First photon of pixel group g that arrives once the dead time after photon last is over.
+        # Usually that is simply the next photon, so only the others are searched for.
+        cand = last + 1
+        tEnd = t[last] + tauDead
+        far = cand < ends[g]
+        far[far] = t[cand[far]] < tEnd[far]
+        if far.any():
+            cand[far] = np.searchsorted(key, g[far]*stride + np.searchsorted(times, tEnd[far]), side="left")
+        return cand
+
+    # Every pixel fires on its first photon
+    fired = np.zeros(n, dtype=bool)
+    fired[starts] = True
+    g = np.arange(len(starts))
+    last = starts
+    cand = nextCandidate(g, last)
+    while len(g):
+        alive = cand < ends[g]
+        g, last, cand = g[alive], last[alive], cand[alive]
+        if tauRecovery > 0:
+            fire = u[cand] < -np.expm1(-(t[cand] - t[last] - tauDead)/tauRecovery)
+        else:
+            fire = np.ones(len(cand), dtype=bool)
+        fired[cand[fire]] = True
+        last = np.where(fire, cand, last)
+        cand = np.where(fire, nextCandidate(g, last), cand + 1)
+
+    mask[order] = fired
+    return mask
+
+class DeadTimeModel:
+    """
+    SPAD response used for the oneHit selection. The default (infinite dead
+    time) keeps the first photon per pixel; a finite tauDead [ns] lets a
+    pixel fire again once it has recovered. The recovery draws come from the
+    dead-time stream of the event (see noise.eventRng), so results do not
+    depend on the order events are processed in.
+    """
+    def __init__(self, tauDead=np.inf, tauRecovery=0.0, seed=0):
+        self.tauDead = tauDead
+        self.tauRecovery = tauRecovery
+        self.seed = seed
+
+    def detected(self, pixels, ts, iEvent=0):
+        if np.isinf(self.tauDead):
+            return firstHitMask(pixels)
+        rng = eventRng(self.seed, iEvent, deadTimeStream) if self.tauRecovery > 0 else None
+        return deadTimeMask(pixels, ts, self.tauDead, self.tauRecovery, rng)
@@ -0,0 +1,209 @@
+import os
+import numpy as np
+import ROOT
+
+from pixelEngine import axisBin, pixelIndex
+from histTools import histArray, sumw2Array
+
+# Number of fill statistics a TH3 keeps (see TH3::GetStats)
+nStatsTH3 = 11
+
+class RootPixelMap:
+    """
+    The original backend: one TH3D filled photon by photon. Kept for weighted
+    fills and as a reference for the compact backends.
+    """
+    def __init__(self, name, title, nBins, lo, hi, nT, tLo, tHi):
+        self.h = ROOT.TH3D(name, title, nBins, lo, hi, nBins, lo, hi, nT, tLo, tHi)
+        self.h.SetDirectory(ROOT.nullptr)
+
+    def fill(self, u, v, t, w=None):
+        w = np.ones(len(u)) if w is None else w
+        for i in range(len(u)):
+            self.h.Fill(u[i], v[i], t[i], w[i])
+
+    def fillPixels(self, pixels, u, v, t, w=None):
+        self.fill(u, v, t, w)
+
+    def reset(self):
+        self.h.Reset()
+
+    def nbytes(self):
+        return 8*self.h.GetNcells()*(2 if self.h.GetSumw2N() else 1)
+
+    def toHist(self):
+        return self.h
+
+class DensePixelMap:
+    """
+    Unit-weight counts in a flat integer array with one entry per TH3D cell,
+    under/overflow included. A quarter of the memory of a TH3D with Sumw2.
+    The TH3D is only built in toHist, at write time.
+    """
+    dtype = np.uint32
+
+    def __init__(self, name, title, nBins, lo, hi, nT, tLo, tHi):
+        self.name, self.title = name, title
+        self.nBins, self.lo, self.hi = nBins, lo, hi
+        self.nT, self.tLo, self.tHi = nT, tLo, tHi
+        self.ncells = (nBins + 2)*(nBins + 2)*(nT + 2)
+        self.reset()
+
+    def reset(self):
+        self.stats = np.zeros(nStatsTH3)
+        self.entries = 0
+        self.allocate()
+
+    def allocate(self):
+        self.counts = np.zeros(self.ncells, dtype=self.dtype)
+
+    def globalBin(self, pixels, t):
+        # TH3 global bin from a TH2 pixel index (see pixelEngine.pixelIndex) and the time bin
+        n = self.nBins + 2
+        bx, by = pixels % n, pixels // n
+        bz = axisBin(t, self.nT, self.tLo, self.tHi)
+        inRange = (bx >= 1) & (bx <= self.nBins) & (by >= 1) & (by <= self.nBins) & (bz >= 1) & (bz <= self.nT)
+        return pixels + n*n*bz, inRange
+
+    def updateStats(self, u, v, t):
+        # Same running sums TH3::Fill keeps, for unit weights and in-range photons only
+        n = len(u)
+        self.stats += [n, n,
+                       u.sum(), (u*u).sum(),
+                       v.sum(), (v*v).sum(), (u*v).sum(),
+                       t.sum(), (t*t).sum(), (u*t).sum(), (v*t).sum()]
+
+    def fill(self, u, v, t, w=None):
+        self.fillPixels(pixelIndex(u, v, self.nBins, self.lo, self.hi), u, v, t, w)
+
+    def fillPixels(self, pixels, u, v, t, w=None):
+        """
+        Fill with pixel indices that were already computed, e.g. a row of
+        pixelEngine.pixelMatrix. u and v are still needed for the statistics.
+        """
+        if w is not None and np.any(w != 1.0):
+            raise ValueError("{} backend only supports unit weights, use the root backend".format(type(self).__name__))
+        u, v, t = (np.asarray(a, dtype=np.float64) for a in (u, v, t))
+        bins, inRange = self.globalBin(np.asarray(pixels, dtype=np.int64), t)
+        self.updateStats(u[inRange], v[inRange], t[inRange])
+        self.entries += len(bins)
+        self.addCounts(*np.unique(bins, return_counts=True))
+
+    def addCounts(self, bins, counts):
+        self.counts[bins] += counts.astype(self.dtype)
+
+    def occupied(self):
+        bins = np.flatnonzero(self.counts)
+        return bins, self.counts[bins]
+
+    def delta(self):
+        # Everything filled since the last reset, compact: occupied cells only
+        bins, counts = self.occupied()
+        return {"bins": bins, "counts": counts, "stats": self.stats, "entries": np.array(self.entries)}
+
+    def addDelta(self, bins, counts, stats, entries):
+        # Add what delta() returned, e.g. of a checkpoint segment
+        self.addCounts(np.asarray(bins, dtype=np.int64), np.asarray(counts))
+        self.stats += stats
+        self.entries += int(entries)
+
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def toHist(self):
+        """
+        Build the TH3D this map stands for: bin contents, Sumw2, entries and
+        fill statistics all match what per-photon Fill calls would give.
+        """
+        h = ROOT.TH3D(self.name, self.title, self.nBins, self.lo, self.hi, self.nBins, self.lo, self.hi, self.nT, self.tLo, self.tHi)
+        h.SetDirectory(ROOT.nullptr)
+        bins, counts = self.occupied()
+        histArray(h)[bins] = counts
+        sumw2Array(h)[bins] = counts
+        h.PutStats(self.stats)
+        h.SetEntries(self.entries)
+        return h
+
+class SparsePixelMap(DensePixelMap):
+    """
+    Dict-of-pixels style store: only occupied cells are kept, as sorted global
+    bin numbers with their counts. New fills are buffered and merged in
+    batches, so memory scales with the number of fired pixels rather than
+    with nBins^2.
+    """
+    maxPending = 1 << 22
+
+    def allocate(self):
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.nPending = 0
+
+    def addCounts(self, bins, counts):
+        self.pending.append((bins, counts))
+        self.nPending += len(bins)
+        if self.nPending > self.maxPending:
+            self.compact()
+
+    def compact(self):
+        if not self.pending:
+            return
+        bins = np.concatenate([self.bins] + [b for b, _ in self.pending])
+        counts = np.concatenate([self.counts] + [c for _, c in self.pending])
+        self.bins, inverse = np.unique(bins, return_inverse=True)
+        self.counts = np.zeros(len(self.bins), dtype=np.int64)
+        np.add.at(self.counts, inverse, counts)
+        self.pending = []
+        self.nPending = 0
+
+    def occupied(self):
+        self.compact()
+        return self.bins, self.counts
+
+    def nbytes(self):
+        return self.bins.nbytes + self.counts.nbytes + sum(b.nbytes + c.nbytes for b, c in self.pending)
+
+def deltaOwners(accumulators):
+    """
+    (name, accumulator) of every accumulator that has a compact delta, once
+    per object: names that alias the same accumulator share its delta.
+    """
+    owners, seen = [], set()
+    for name, m in accumulators.items():
+        if hasattr(m, "delta") and id(m) not in seen:
+            owners.append((name, m))
+            seen.add(id(m))
+    return owners
+
+def saveDeltas(path, accumulators):
+    """
+    Write the deltas of the compact accumulators (pixel maps, CountHists) to
+    one .npz file, instead of full ROOT histograms. Returns the names saved;
+    root backend maps and ROOT histograms have no delta and are left to the
+    caller.
+    """
+    arrays = {}
+    for name, m in deltaOwners(accumulators):
+        for key, vals in m.delta().items():
+            arrays[name + "/" + key] = vals
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+    return [name for name, m in accumulators.items() if hasattr(m, "delta")]
+
+def loadDeltas(m, name, paths):
+    # Add the deltas of accumulator name saved in each of paths to m
+    for path in paths:
+        with np.load(path) as deltas:
+            m.addDelta(*(deltas[name + "/" + key] for key in ("bins", "counts", "stats", "entries")))
+
+pixelMapBackends = {
+    "root": RootPixelMap,
+    "dense": DensePixelMap,
+    "sparse": SparsePixelMap,
+}
+
+def makePixelMap(backend, name, title, nBins, lo, hi, nT, tLo, tHi):
+    if backend not in pixelMapBackends:
+        raise ValueError("Unknown pixel map backend '{}', choose from {}".format(backend, list(pixelMapBackends)))
+    return pixelMapBackends[backend](name, title, nBins, lo, hi, nT, tLo, tHi)
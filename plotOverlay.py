@@ -1,8 +1,10 @@
+import sys
 import ROOT
 import re
+from renderQueue import renderAll
 
 # File and histogram base name
-file_path = "outfile.root"
+file_path = sys.argv[1] if len(sys.argv) > 1 else "outfile.root"
 histogram_suffix = "nPhotonsPerChannel"
 
 # Open ROOT file
@@ -24,50 +26,34 @@ def extract_sort_key(name):
 # Sort histograms by the extracted number
 matching_hists.sort(key=extract_sort_key)
 
-# Prepare canvas and legend
-canvas = ROOT.TCanvas("canvas", "Overlayed Histograms", 800, 600)
-canvas.SetLogy()
-canvas.SetTickx()
-canvas.SetTicky()
-legend = ROOT.TLegend(0.65, 0.5, 0.88, 0.88)
-legend.SetBorderSize(0)
-legend.SetFillStyle(0)
+# Canvas style of the overlay
+style = {
+    "canvas": [800, 600],
+    "margins": [0.1, 0.1, 0.1, 0.1],
+    "ticks": [1, 1],
+    "logy": True,
+}
 
 # Colors for plotting
 colors = [ROOT.kRed, ROOT.kBlue, ROOT.kGreen+2, ROOT.kMagenta, ROOT.kOrange+7, ROOT.kCyan+2]
 
-# Draw histograms
+# One layer per histogram, normalized
+layers = []
 for i, hist_name in enumerate(matching_hists):
-    hist = f.Get(hist_name)
-    if not hist:
+    if not f.Get(hist_name):
         continue
 
-    if hist.Integral() > 0:
-        hist.Scale(1.0/hist.Integral())
-
-    hist.SetLineColor(colors[i % len(colors)])
-    hist.SetLineWidth(2)
-    hist.SetStats(0)
-
-    # Set axis titles only once
-    if i == 0:
-        hist.GetXaxis().SetTitle("NPhotons per channel")
-        hist.GetYaxis().SetTitle("Normalized")
-        hist.SetMinimum(1e-8)
-        hist.GetXaxis().SetRange(1,15)
-        hist.Draw("HIST")
-    else:
-        hist.Draw("HIST SAME")
-
     # Add legend entry with prefix only
     prefix = hist_name.replace(histogram_suffix + "_", "") + (" #mum^{2}")
-    legend.AddEntry(hist, prefix, "l")
+    layer = {"name": hist_name, "draw": "HIST SAME", "normalize": True, "color": colors[i % len(colors)], "width": 2, "stats": 0, "label": prefix}
 
+    # Set axis titles only once
+    if not layers:
+        layer.update({"draw": "HIST", "xtitle": "NPhotons per channel", "ytitle": "Normalized", "minimum": 1e-8, "xbins": [1, 15]})
+    layers.append(layer)
 
-f.Get(matching_hists[0]).Draw("AXIS SAME")
-legend.Draw()
-#canvas.SetGrid()
-canvas.Update()
+layers.append({"name": matching_hists[0], "draw": "AXIS SAME"})
+f.Close()
 
-# Save output if needed
-canvas.SaveAs("output/overlayed_histograms.png")
+job = {"file": file_path, "out": "output/overlayed_histograms.png", "style": style, "layers": layers, "legend": [0.65, 0.5, 0.88, 0.88]}
+renderAll([job])
@@ -0,0 +1,223 @@
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import ROOT
+from histTools import histArray
+
+# Pad style used by makeProjections and simSPADs
+padStyle = {
+    "canvas": [800, 700],
+    "margins": [0.12, 0.15, 0.08, 0.12], # left, right, top, bottom
+    "ticks": [1, 1],
+    "logy": False,
+    "optFit": 1,
+}
+
+def histJob(file_path, name, out_path, drawOpt="COLZ", style=padStyle, **layer):
+    """
+    Queue entry that draws one object of file_path into out_path. Extra
+    keyword arguments are layer settings, see drawLayer.
+    """
+    layer.update({"name": name, "draw": drawOpt})
+    return {"file": file_path, "out": out_path, "style": dict(style), "layers": [layer], "legend": None}
+
+#############################################
+# Worker side
+#############################################
+
+# One batch-mode canvas and one handle per input file for each worker process
+_canvas = None
+_files = {}
+
+def getCanvas(style):
+    global _canvas
+    ROOT.gROOT.SetBatch(True)
+    if _canvas is None:
+        _canvas = ROOT.TCanvas("c", "c", *style["canvas"])
+    _canvas.SetCanvasSize(*style["canvas"])
+    _canvas.Clear()
+    _canvas.cd()
+    ROOT.gStyle.SetOptFit(style.get("optFit", 1))
+    left, right, top, bottom = style["margins"]
+    ROOT.gPad.SetLeftMargin(left)
+    ROOT.gPad.SetRightMargin(right)
+    ROOT.gPad.SetTopMargin(top)
+    ROOT.gPad.SetBottomMargin(bottom)
+    ROOT.gPad.SetTicks(*style["ticks"])
+    ROOT.gPad.SetLogy(1 if style.get("logy") else 0)
+    return _canvas
+
+def getObject(file_path, name):
+    if file_path not in _files:
+        _files[file_path] = ROOT.TFile.Open(file_path, "READ")
+    obj = _files[file_path].Get(name)
+    if not obj:
+        raise KeyError("{} not found in {}".format(name, file_path))
+    if hasattr(obj, "SetDirectory"):
+        obj.SetDirectory(ROOT.nullptr)
+        ROOT.SetOwnership(obj, True)
+    return obj
+
+def drawLayer(obj, layer):
+    """
+    Apply the per-object settings of a layer and draw it. Supported keys:
+    stats, normalize, maximum, minimum, color, width, xtitle, ytitle,
+    xbins (first, last bin shown).
+    """
+    if layer.get("normalize") and obj.Integral() > 0:
+        obj.Scale(1.0/obj.Integral())
+    if "stats" in layer:
+        obj.SetStats(layer["stats"])
+    if "maximum" in layer:
+        obj.SetMaximum(layer["maximum"])
+    if "minimum" in layer:
+        obj.SetMinimum(layer["minimum"])
+    if "color" in layer:
+        obj.SetLineColor(layer["color"])
+    if "width" in layer:
+        obj.SetLineWidth(layer["width"])
+    if "xtitle" in layer:
+        obj.GetXaxis().SetTitle(layer["xtitle"])
+    if "ytitle" in layer:
+        obj.GetYaxis().SetTitle(layer["ytitle"])
+    if "xbins" in layer:
+        obj.GetXaxis().SetRange(*layer["xbins"])
+    obj.Draw(layer["draw"])
+
+def contentHash(job, objs):
+    """
+    Hash of everything that ends up in the image: the bin contents, binning
+    and titles of the drawn histograms plus the draw options and style.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps({key: job[key] for key in ("style", "layers", "legend")}, sort_keys=True).encode())
+    for obj in objs:
+        h.update(obj.GetTitle().encode())
+        for axis in (obj.GetXaxis(), obj.GetYaxis(), obj.GetZaxis()):
+            h.update(np.array([axis.GetNbins(), axis.GetXmin(), axis.GetXmax(), axis.GetFirst(), axis.GetLast()], dtype=np.float64).tobytes())
+        h.update(histArray(obj).tobytes())
+    return h.hexdigest()
+
+def renderJob(job):
+    """
+    Draw one job and save it. The image is left alone when its content hash
+    matches job["cachedHash"]. Returns (output path, hash, rendered).
+    """
+    objs = [getObject(job["file"], layer["name"]) for layer in job["layers"]]
+    digest = contentHash(job, objs)
+    if digest == job.get("cachedHash"):
+        return job["out"], digest, False
+
+    c = getCanvas(job["style"])
+    keep = []
+    for obj, layer in zip(objs, job["layers"]):
+        drawLayer(obj, layer)
+        keep.append(obj)
+
+    legend = None
+    if job["legend"] is not None:
+        x1, y1, x2, y2 = job["legend"]
+        legend = ROOT.TLegend(x1, y1, x2, y2)
+        legend.SetBorderSize(0)
+        legend.SetFillStyle(0)
+        for obj, layer in zip(keep, job["layers"]):
+            if "label" in layer:
+                legend.AddEntry(obj, layer["label"], "l")
+        legend.Draw()
+    c.Update()
+
+    os.makedirs(os.path.dirname(job["out"]) or ".", exist_ok=True)
+    c.SaveAs(job["out"])
+    return job["out"], digest, True
+
+#############################################
+# Queue side
+#############################################
+
+# Content hashes of the images rendered so far
+defaultCachePath = os.path.join("output", ".renderCache.json")
+
+class RenderCache:
+    """
+    Index of rendered images: output path -> content hash and the image
+    modification time at render. An entry only counts while the image is
+    still there and untouched, otherwise it is stale and gets evicted.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def valid(self, out):
+        entry = self.entries.get(out)
+        return entry is not None and os.path.exists(out) and os.path.getmtime(out) == entry["mtime"]
+
+    def lookup(self, out):
+        return self.entries[out]["hash"] if self.valid(out) else None
+
+    def update(self, out, digest):
+        self.entries[out] = {"hash": digest, "mtime": os.path.getmtime(out)}
+
+    def evict(self):
+        stale = [out for out in self.entries if not self.valid(out)]
+        for out in stale:
+            del self.entries[out]
+        return len(stale)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+def renderAll(jobs, nJobs=1, cachePath=defaultCachePath):
+    """
+    Render a list of queued jobs, on a pool of nJobs processes if nJobs > 1.
+    Every worker has its own batch canvas, so jobs are independent. With a
+    cachePath, images whose content hash did not change are not redrawn.
+    Returns (output path, hash, rendered) per job.
+    """
+    cache = RenderCache(cachePath) if cachePath else None
+    if cache is not None:
+        cache.evict()
+        jobs = [dict(job, cachedHash=cache.lookup(job["out"])) for job in jobs]
+
+    if nJobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(nJobs, len(jobs))) as pool:
+            results = pool.map(renderJob, jobs, chunksize=1)
+    else:
+        results = [renderJob(job) for job in jobs]
+
+    if cache is not None:
+        for out, digest, rendered in results:
+            if rendered:
+                cache.update(out, digest)
+        cache.save()
+    return results
+
+def saveJobs(path, jobs):
+    # Keep the queue on disk so images can be rendered later
+    with open(path, "w") as f:
+        json.dump(jobs, f, indent=2)
+
+def loadJobs(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a saved queue of ROOT plots to images")
+    parser.add_argument("queue", help="JSON render queue written by makeProjections or plotOverlay")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="Number of rendering processes")
+    parser.add_argument("--no-cache", action="store_true", help="Redraw every image, even if it is up to date")
+    args = parser.parse_args()
+    results = renderAll(loadJobs(args.queue), args.jobs, None if args.no_cache else defaultCachePath)
+    nRendered = sum(rendered for _, _, rendered in results)
+    print("Rendered {} images, {} up to date".format(nRendered, len(results) - nRendered))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 import sys
-import random
-import math
+import argparse
+import glob
+import json
 import numpy as np
 import ROOT
-import copy
 import os
+import resource
+import time
+import shutil
+import concurrent.futures
+from eventReader import iterChunks, PhotonSelection, Prefetcher, enableThreadedReads, branchBytes, photonBytes
+from pixelEngine import pixelMatrix, channelOccupancy, DeadTimeModel
+from pixelMaps import makePixelMap, pixelMapBackends, saveDeltas, loadDeltas, deltaOwners
+from mergeOutputs import mergeFiles, mergeTree, combineFiles, histNames
+from checkpoint import Checkpointer, deltaPath
+from waveforms import WaveformSynth
+from noise import DarkCounts, addDarkCounts, eventRng, electronicNoise, electronicNoiseStream
+from histTools import histArray, sumw2Array
+from histBook import CountHist, HistBook
+from eventReducer import EventReducer
+from photonCache import cacheKey, openCache, PhotonCacheWriter
+from instrumentation import stats, RunStats, writeReport
 
 ROOT.gROOT.SetBatch(True)
 ROOT.TH1.SetDefaultSumw2()
@@ -17,6 +33,8 @@ yShift = [-3.7293, -3.6878, -3.6878, -3.6488]
 
 # (distance_limit_from_center, shift_amount_toward_center)
 shrink_rules = [(0.1 + 0.4 * i, round(0.23 * i, 2)) for i in range(40)]
+shrink_limits = np.array([limit for limit, _ in shrink_rules])
+shrink_shifts = np.array([shift for _, shift in shrink_rules] + [2.0])
 
 def shrink_toward_center(val: float) -> float:
     """
@@ -29,6 +47,15 @@ def shrink_toward_center(val: float) -> float:
     # Anything farther than the last limit: apply a constant max-shift (2.0 here)
     return val - 2.0 * np.sign(val)
 
+def shrink_toward_center_array(vals):
+    """
+    Array version of shrink_toward_center. The first rule with abs(val) <= limit
+    is found with a searchsorted over the rule limits; values past the last
+    limit pick up the trailing 2.0 max-shift.
+    """
+    idx = np.searchsorted(shrink_limits, np.abs(vals), side="left")
+    return vals - shrink_shifts[idx] * np.sign(vals)
+
 class Photons:
     def __init__(self, event):
         #Sort by arrival time of the photon
@@ -67,6 +94,23 @@ class Photons:
     def fiberNumber(self, i):
         return self.productionFiber[i]
 
+    # Whole-event versions of x, y, z and t. These return the same values as
+    # the per-photon accessors, bit-for-bit, as arrays in time-sorted order.
+    def xArray(self):
+        raw_x = self.pos_final_x + np.asarray(xShift)[self.productionFiber]
+        return shrink_toward_center_array(raw_x)
+
+    def yArray(self):
+        raw_y = self.pos_final_y + np.asarray(yShift)[self.productionFiber]
+        return shrink_toward_center_array(raw_y)
+
+    def zArray(self):
+        return self.pos_produced_z
+    def zEndArray(self):
+        return self.pos_final_z
+    def tArray(self):
+        return self.time_final
+
 class SiPMInfo:
     def __init__(self, channelSize, nBins):
         self.channelSize = channelSize #microns
@@ -86,26 +130,17 @@ def saveHisto(c, hDic, name, drawOpt="", doLog=False):
 def getNBins(l,h,s):
     return int((h - l)/s)
 
-def main():
-    # Some useful hardcoded stuff
-    if len(sys.argv) < 2:
-       print("❌ Error: please provide a ROOT file as argument.")
-       sys.exit(1)
-    input_file_path = sys.argv[1]
-    input_file = ROOT.TFile(input_file_path, "READ")
-    tree = input_file.Get("tree")
-    root_file = ROOT.TFile("outfile.root", "RECREATE")
-    os.makedirs("output/", exist_ok=True)
-
-    # Define histos
-    histos = {}
+xBinL = -40.0
+xBinH =  40.0
 
-    xBinL = -40.0
-    xBinH =  40.0
-
-    print(getNBins(xBinL,xBinH,0.01))
-
-    nChannels = [
+def getChannels(pitches=None):
+    """
+    SiPMs to simulate. pitches is a list of pitches in um; by default the
+    production list below is used.
+    """
+    if pitches:
+        return [SiPMInfo(p, getNBins(xBinL,xBinH,p/1000.0)) for p in pitches]
+    return [
         #SiPMInfo(   1, getNBins(xBinL,xBinH,0.001), 
         #SiPMInfo(  10, getNBins(xBinL,xBinH,0.010)), 
         SiPMInfo(  20,  getNBins(xBinL,xBinH,0.020)), 
@@ -123,81 +158,583 @@ def main():
         #SiPMInfo(3000,    1),
     ]
 
-    for c in nChannels: histos[        "nPhotons_xyt_all_{}".format(c.name)] = ROOT.TH3D(        "nPhotons_xyt_all_{}".format(c.name),"nPhotons_xyt; y [mm]; x [mm]; t [ns]; nPhotons", c.nBins    ,xBinL,xBinH, c.nBins,xBinL,xBinH, 1,5.0, 40.0)
-    for c in nChannels: histos[        "nPhotons_rte_all_{}".format(c.name)] = ROOT.TH3D(        "nPhotons_rte_all_{}".format(c.name),"nPhotons_rt;  r [mm]; t [ns]; events; nPhotons", 60,0.0,0.5,    700,5.0, 40.0, 100,  0,  100)
-    for c in nChannels: histos[        "nPhotons_rze_all_{}".format(c.name)] = ROOT.TH3D(        "nPhotons_rze_all_{}".format(c.name),"nPhotons_rz;  r [mm]; z [mm]; events; nPhotons", 60,0.0,0.5,    500,0.0,2000.0, 100,  0,  100)
-    for c in nChannels: histos[        "nPhotons_tze_all_{}".format(c.name)] = ROOT.TH3D(        "nPhotons_tze_all_{}".format(c.name),"nPhotons_rz;  t [ns]; z [mm]; events; nPhotons", 700,5.0, 40.0, 500,0.0,2000.0, 100,  0,  100)
-    for c in nChannels: histos[     "nPhotons_xyt_oneHit_{}".format(c.name)] = ROOT.TH3D(     "nPhotons_xyt_oneHit_{}".format(c.name),"nPhotons_xyt; y [mm]; x [mm]; t [ns]; nPhotons", c.nBins    ,xBinL,xBinH, c.nBins,xBinL,xBinH, 1,5.0, 40.0)
-    for c in nChannels: histos[     "nPhotons_rte_oneHit_{}".format(c.name)] = ROOT.TH3D(     "nPhotons_rte_oneHit_{}".format(c.name),"nPhotons_rt;  r [mm]; t [ns]; events; nPhotons", 60,0.0,0.5,    700,5.0, 40.0, 100,  0,  100)
-    for c in nChannels: histos[     "nPhotons_rze_oneHit_{}".format(c.name)] = ROOT.TH3D(     "nPhotons_rze_oneHit_{}".format(c.name),"nPhotons_rz;  r [mm]; z [mm]; events; nPhotons", 60,0.0,0.5,    500,0.0,2000.0, 100,  0,  100)
-    for c in nChannels: histos[     "nPhotons_tze_oneHit_{}".format(c.name)] = ROOT.TH3D(     "nPhotons_tze_oneHit_{}".format(c.name),"nPhotons_rz;  t [ns]; z [mm]; events; nPhotons", 700,5.0, 40.0, 500,0.0,2000.0, 100,  0,  100)
-    for c in nChannels: histos["temp_nPhotons_xyt_oneHit_{}".format(c.name)] = ROOT.TH2D("temp_nPhotons_xyt_oneHit_{}".format(c.name),"nPhotons_xyt; y [mm]; x [mm]; t [ns]; nPhotons", c.nBins    ,xBinL,xBinH, c.nBins,xBinL,xBinH)
+def bookHistos(nChannels, pixelMapBackend, nTimeBins=1, waveforms=False, eventAxis="bins", eventQuantiles=False):
+    histos = HistBook()
+
+    # The xyt maps are the big ones; they live in a compact accumulator until write time
+    pixelMaps = {}
+    for c in nChannels: pixelMaps[        "nPhotons_xyt_all_{}".format(c.name)] = makePixelMap(pixelMapBackend,        "nPhotons_xyt_all_{}".format(c.name),"nPhotons_xyt; y [mm]; x [mm]; t [ns]; nPhotons", c.nBins, xBinL, xBinH, nTimeBins, 5.0, 40.0)
+    for c in nChannels: pixelMaps[     "nPhotons_xyt_oneHit_{}".format(c.name)] = makePixelMap(pixelMapBackend,     "nPhotons_xyt_oneHit_{}".format(c.name),"nPhotons_xyt; y [mm]; x [mm]; t [ns]; nPhotons", c.nBins, xBinL, xBinH, nTimeBins, 5.0, 40.0)
+
+    # Unit-weight families are integer counts until write time. The "all" selection is the same for
+    # every pitch, so one histogram per family is filled and written under every pitch name.
+    # With eventAxis "reduce" the events axis is a single bin and an EventReducer per histogram
+    # (name + "_ev") keeps the event-to-event statistics instead.
+    events = (100, 0, 100) if eventAxis == "bins" else (1, 0, float(1 << 31))
+    families = [
+        ("rte", "nPhotons_rt;  r [mm]; t [ns]; events; nPhotons", (60,0.0,0.5),   (700,5.0, 40.0)),
+        ("rze", "nPhotons_rz;  r [mm]; z [mm]; events; nPhotons", (60,0.0,0.5),   (500,0.0,2000.0)),
+        ("tze", "nPhotons_rz;  t [ns]; z [mm]; events; nPhotons", (700,5.0, 40.0), (500,0.0,2000.0)),
+    ]
+    first = nChannels[0].name
+    for sel in ("all", "oneHit"):
+        for family, title, xAxis, yAxis in families:
+            for c in (nChannels[:1] if sel == "all" else nChannels):
+                name = "nPhotons_{}_{}_{}".format(family, sel, c.name)
+                histos.book(name, CountHist(name, title, xAxis, yAxis, events))
+                if eventAxis == "reduce":
+                    histos.book(name + "_ev", EventReducer(name, title, xAxis, yAxis, eventQuantiles))
+            if sel == "all":
+                for c in nChannels[1:]:
+                    name = "nPhotons_{}_all_{}".format(family, c.name)
+                    histos.alias(name, "nPhotons_{}_all_{}".format(family, first))
+                    if eventAxis == "reduce":
+                        histos.alias(name + "_ev", "nPhotons_{}_all_{}_ev".format(family, first))
+
+    # Counts of empty channels add up to nBins^2 per event, too many for 32 bits
+    for c in nChannels: histos.book(      "nPhotonsPerChannel_{}".format(c.name), CountHist(      "nPhotonsPerChannel_{}".format(c.name),"nPhotonsChannel; nPhotons", (30, 0, 30), dtype=np.int64))
+    if waveforms:
+        # Weighted fills, so a plain ROOT histogram. Not owned by any file, so it can be written to checkpoints and to the output
+        for c in nChannels:
+            histos.book("signal_time_{}".format(c.name), ROOT.TH1D("signal_time_{}".format(c.name),"signal_time; time [ns]; Amplitude [mV]", 500, 0.0, 25.0))
+            histos["signal_time_{}".format(c.name)].SetDirectory(ROOT.nullptr)
+
+    return histos, pixelMaps
+
+def resetHistos(histos, pixelMaps):
+    with stats.stage("reset", len(histos) + len(pixelMaps)):
+        histos.reset()
+        for m in pixelMaps.values(): m.reset()
+
+def transformPhotons(g):
+    #Transform the whole event at once
+    return 10*g.xArray(), 10*g.yArray(), 20*g.zArray() + 2000, g.tArray()
+
+def selectPhotons(g, ts, selection=None):
+    #Select good photons, by default from C fibers
+    isGoodPhoton = (selection or PhotonSelection()).mask(g.isCoreC, g.zEndArray(), ts)
+    return np.flatnonzero(isGoodPhoton)
+
+def pixelizeEvent(nChannels, xs, ys, ts=None, spad=None, iEvent=0):
+    #Pixel index of every photon for every pitch, one row per SiPMInfo
+    pixels = pixelMatrix(ys, xs, [c.nBins for c in nChannels], xBinL, xBinH)
+
+    #Photons that fire their pixel, per SiPM pitch: the first one only, unless the SPADs recover
+    spad = spad or DeadTimeModel()
+    isOneHit = spad.detected(pixels, ts, iEvent)
+    return pixels, isOneHit
+
+def fillHistos(histos, pixelMaps, nChannels, iEvent, xs, ys, zs, ts, ws, pixels, isOneHit, isDark=None):
+    if np.any(ws != 1.0):
+        raise ValueError("The histogram fills assume unit photon weights")
+    for k, c in enumerate(nChannels):
+        pixelMaps["nPhotons_xyt_all_{}".format(c.name)].fillPixels(pixels[k], ys, xs, ts, ws)
+        oneHit = isOneHit[k]
+        pixelMaps["nPhotons_xyt_oneHit_{}".format(c.name)].fillPixels(pixels[k][oneHit], ys[oneHit], xs[oneHit], ts[oneHit], ws[oneHit])
+
+    #All photons of the event at once; dark counts only go into the pixel maps
+    photons = slice(None) if isDark is None else ~isDark
+    xs, ys, zs, ts, isOneHit = xs[photons], ys[photons], zs[photons], ts[photons], isOneHit[:, photons]
+    rs = np.sqrt(xs**2 + ys**2)
+    events = np.full(len(xs), float(iEvent))
+    for family, coords in (("rte", (rs, ts, events)), ("rze", (rs, zs, events)), ("tze", (ts, zs, events))):
+        # Bins are found once per family and shared by the all and oneHit histograms of every pitch
+        hAll = histos.handles("nPhotons_" + family + "_all_{}", nChannels)[0]
+        bins, inRange = hAll.bins(*coords)
+        hAll.fillBins(bins, inRange, *coords)
+        for k, h in enumerate(histos.handles("nPhotons_" + family + "_oneHit_{}", nChannels)):
+            oneHit = isOneHit[k]
+            h.fillBins(bins[oneHit], inRange[oneHit], *(x[oneHit] for x in coords))
+
+        if "nPhotons_" + family + "_all_" + nChannels[0].name + "_ev" in histos:
+            # The (x, y) part of the global bin is the 2D bin of the per-event map
+            bins2D = bins % histos.handles("nPhotons_" + family + "_all_{}_ev", nChannels)[0].ncells
+            histos.handles("nPhotons_" + family + "_all_{}_ev", nChannels)[0].add(bins2D)
+            for k, r in enumerate(histos.handles("nPhotons_" + family + "_oneHit_{}_ev", nChannels)):
+                r.add(bins2D[isOneHit[k]])
+
+def fillOccupancy(histos, nChannels, pixels):
+    # Fill the nPhotons per channel summary histogram from the fired pixels only
+    for k, h in enumerate(histos.handles("nPhotonsPerChannel_{}", nChannels)):
+        nPhotonsPerChannel, nChannelsWithCount = channelOccupancy(pixels[k], nChannels[k].nBins)
+        h.fill(nPhotonsPerChannel, counts=nChannelsWithCount)
+
+def selectedPhotons(g, selection=None, preselected=False):
+    """
+    Transformed x, y, z, t, weight and fiber of the good photons of an
+    event, in arrival order. This is everything the pixel logic needs.
+    preselected means the reader already applied the selection.
+    """
+    nAll = g.nPhotons()
+    with stats.stage("transform", nAll):
+        xs, ys, zs, ts = transformPhotons(g)
+    if preselected:
+        return xs, ys, zs, ts, g.w, g.productionFiber
+    with stats.stage("selection", nAll):
+        goodPhotons = selectPhotons(g, ts, selection)
+    return xs[goodPhotons], ys[goodPhotons], zs[goodPhotons], ts[goodPhotons], g.w[goodPhotons], g.productionFiber[goodPhotons]
+
+def fillWaveforms(histos, nChannels, synth, pixels, ts, isOneHit, noise=None):
+    # Analog sum of the waveforms of every fired channel, plus electronic noise, added up over events
+    for k, c in enumerate(nChannels):
+        wave = synth.summed(pixels[k][isOneHit[k]], ts[isOneHit[k]])
+        if noise is not None:
+            wave = wave + noise[k]
+        h = histos["signal_time_{}".format(c.name)]
+        histArray(h)[1:-1] += wave
+        sumw2Array(h)[1:-1] += wave*wave
+        h.SetEntries(h.GetEntries() + 1)
+
+def processPhotons(histos, pixelMaps, nChannels, iEvent, xs, ys, zs, ts, ws, spad=None, synth=None, dark=None, noiseSigma=0.0):
+    # Pixel logic and fills for the selected photons of one event
+    stats.count("good photons", len(xs))
+    isDark = None
+    if dark is not None:
+        with stats.stage("dark counts", len(xs)):
+            xs, ys, zs, ts, ws, isDark = addDarkCounts(dark, iEvent, xs, ys, zs, ts, ws)
+        stats.count("dark counts", int(isDark.sum()))
+    nGood = len(xs)
+    with stats.stage("oneHit", nGood*len(nChannels)):
+        pixels, isOneHit = pixelizeEvent(nChannels, xs, ys, ts, spad, iEvent)
+    with stats.stage("fills", nGood*len(nChannels)):
+        fillHistos(histos, pixelMaps, nChannels, iEvent, xs, ys, zs, ts, ws, pixels, isOneHit, isDark)
+    with stats.stage("nPhotonsPerChannel", nGood*len(nChannels)):
+        fillOccupancy(histos, nChannels, pixels)
+    if synth is not None:
+        with stats.stage("waveforms", int(isOneHit.sum())):
+            noise = None
+            if noiseSigma > 0:
+                noise = electronicNoise(eventRng(synth.seed, iEvent, electronicNoiseStream), (len(nChannels), synth.nSamples), noiseSigma)
+            fillWaveforms(histos, nChannels, synth, pixels, ts, isOneHit, noise)
+
+def processEvent(histos, pixelMaps, nChannels, g, iEvent, selection=None):
+    xs, ys, zs, ts, ws, fibers = selectedPhotons(g, selection)
+    processPhotons(histos, pixelMaps, nChannels, iEvent, xs, ys, zs, ts, ws)
+
+def calibration(selection):
+    # Everything that goes into the selected, transformed photons; part of the photon cache key
+    return {
+        "xShift": xShift,
+        "yShift": yShift,
+        "shrink_rules": shrink_rules,
+        "transform": "10*x, 10*y, 20*z + 2000, t",
+        "selection": selection.expression(),
+    }
+
+def getSelection(args):
+    return PhotonSelection(not args.all_fibers, args.z_end_min, *args.time_window)
+
+def runSettings(args):
+    # Everything besides the inputs and pitches that changes the simulated histograms.
+    # Strict JSON has no Infinity, so no dead time (inf) is stored as None.
+    return {"deadTime": None if np.isinf(args.dead_time) else args.dead_time, "recoveryTime": args.recovery_time, "timeBins": args.time_bins, "seed": args.seed,
+            "waveforms": [args.amplitude, args.gain_spread, args.noise] if args.waveforms else None, "darkRate": args.dark_rate,
+            "eventAxis": args.event_axis, "eventQuantiles": args.event_quantiles, "selection": getSelection(args).expression()}
+
+def iterTreePhotons(chunks, cacheWriter=None):
+    """
+    Entry, number of photons and the selected photons (x, y, z, t, weight)
+    of every event of the chunks read from the tree. The selection was
+    applied by the reader, so only the selected photons are sorted and
+    transformed. With a cacheWriter the selected photons are also stored in
+    the photon cache.
+    """
+    for chunk in chunks:
+        for event in chunk:
+            with stats.stage("Photons build", len(event.OP_time_final)):
+                g = Photons(event)
+            xs, ys, zs, ts, ws, fibers = selectedPhotons(g, preselected=True)
+            if cacheWriter is not None:
+                cacheWriter.append(event.nAll, xs, ys, zs, ts, fibers)
+            yield event.entry, event.nAll, xs, ys, zs, ts, ws
+
+def iterCachedPhotons(cache, first, last):
+    # Same as iterTreePhotons, straight from the memory mapped photon cache
+    for event in cache.iterEvents(first, last):
+        yield event.entry, event.nPhotons, event.x, event.y, event.z, event.t, np.ones(len(event.x))
+
+def writeOutput(output_file_path, histos, pixelMaps, delta_path=None):
+    """
+    Write everything out, building the xyt TH3Ds one at a time. The file is
+    written under a temporary name and moved into place once complete.
+    With delta_path (checkpoint segments) the compact pixel maps and
+    CountHists are saved there as occupied cells only, and no ROOT histogram
+    is built for them.
+    """
+    with stats.stage("write", len(histos) + len(pixelMaps)):
+        saved = saveDeltas(delta_path, dict(pixelMaps, **histos)) if delta_path else []
+        root_file = ROOT.TFile(output_file_path + ".tmp", "RECREATE")
+        for name, m in pixelMaps.items():
+            if name in saved: continue
+            h = m.toHist()
+            h.Write()
+            del h
+        for name in histos:
+            if name in saved: continue
+            for h in histos.toHists(name):
+                h.Write()
+            del h
+        root_file.Close()
+        os.replace(output_file_path + ".tmp", output_file_path)
+
+def writeDeltas(output_file_path, histos, pixelMaps, delta_paths):
+    """
+    Add what the checkpoint segments saved as deltas to an output: the
+    deltas of each accumulator are summed in it and its ROOT histograms are
+    built once, one accumulator at a time. The accumulators are left empty.
+    """
+    # Every name an accumulator is written under, e.g. the aliases of a shared CountHist
+    names = {}
+    for name, m in list(pixelMaps.items()) + list(histos.items()):
+        names.setdefault(id(m), []).append(name)
+    with stats.stage("write", len(histos) + len(pixelMaps)):
+        root_file = ROOT.TFile(output_file_path, "UPDATE")
+        for owner, m in deltaOwners(dict(pixelMaps, **histos)):
+            m.reset()
+            loadDeltas(m, owner, delta_paths)
+            hists = [m.toHist()] if owner in pixelMaps else [h for name in names[id(m)] for h in histos.toHists(name)]
+            for h in hists:
+                h.Write()
+            del hists
+            m.reset()
+        root_file.Close()
+
+def simulate(input_file_path, output_file_path, args, first=0, last=None, eventOffset=0):
+    """
+    Run the SPAD simulation over entries [first, last) of the input tree and
+    write the histograms to output_file_path. The events axis of the
+    rte/rze/tze histograms is eventOffset plus the tree entry number, so
+    outputs of disjoint entry ranges, or of files given consecutive offsets,
+    add up to the output of a single run over all of them.
+
+    With checkpointing on, the histograms are flushed to a checkpoint segment
+    every args.checkpoint_every events or args.checkpoint_minutes minutes, and
+    args.resume picks an interrupted run up from its last checkpoint.
+
+    With args.photon_cache set, the selected and transformed photons are read
+    from the cache if this file and entry range are already in it, and are
+    otherwise stored there on the way through the tree.
+    """
+    input_file = ROOT.TFile(input_file_path, "READ")
+    tree = input_file.Get("tree")
+    if last is None:
+        last = tree.GetEntries()
+
+    nChannels = getChannels(args.pitches)
+    histos, pixelMaps = bookHistos(nChannels, args.pixel_map_backend, args.time_bins, args.waveforms, args.event_axis, args.event_quantiles)
+    spad = DeadTimeModel(args.dead_time, args.recovery_time, args.seed)
+    synth = WaveformSynth(args.amplitude, args.gain_spread, args.seed) if args.waveforms else None
+    dark = DarkCounts(args.dark_rate, xBinL, xBinH, 0.0, 40.0, args.seed) if args.dark_rate > 0 else None
+    selection = getSelection(args)
 
-    for c in nChannels: histos[       "dummy_nPhotons_xy_{}".format(c.name)] = ROOT.TH2D(       "dummy_nPhotons_xy_{}".format(c.name),"nPhotons_xy; y [cm]; x [cm]; nPhotons", c.nBins,xBinL,xBinH, c.nBins,xBinL,xBinH)
-    for c in nChannels: histos[      "nPhotonsPerChannel_{}".format(c.name)] = ROOT.TH1D(      "nPhotonsPerChannel_{}".format(c.name),"nPhotonsChannel; nPhotons", 30, 0, 30)
+    runInfo = {"input": os.path.abspath(input_file_path), "first": first, "last": last, "eventOffset": eventOffset, "channels": [c.name for c in nChannels]}
+    runInfo.update(runSettings(args))
+    ckpt = Checkpointer(output_file_path + ".ckpt", runInfo, args.checkpoint_every, args.checkpoint_minutes)
+    resumeEntry = ckpt.resume() if args.resume else None
+
+    cache, cacheWriter = None, None
+    if args.photon_cache:
+        key = cacheKey(input_file_path, first, last, calibration(selection), input_file.GetUUID().AsString())
+        cache = openCache(args.photon_cache, key)
+        if cache is None and resumeEntry is None:
+            # Only a run over the whole range can fill the cache
+            cacheWriter = PhotonCacheWriter(args.photon_cache, key, first, {"input": os.path.abspath(input_file_path), "last": last})
+        print("Photon cache {}: {}".format(key[:12], "hit" if cache is not None else "miss"))
+
+    if resumeEntry is not None:
+        first = resumeEntry
+    prefetcher = None
+    if cache is not None:
+        photonSource = iterCachedPhotons(cache, first, last)
+    else:
+        # With prefetching the next chunks are read in a background thread while this one is processed
+        chunks = iterChunks(tree, args.chunk_size, first, last, selection)
+        if args.prefetch > 0:
+            enableThreadedReads()
+            chunks = prefetcher = Prefetcher(chunks, args.prefetch)
+        photonSource = iterTreePhotons(chunks, cacheWriter)
+    bytesRead, bytesTotal = branchBytes(tree)
+    entriesInTree = max(tree.GetEntries(), 1)
 
     # Loop over events
-    nEvents = -1
-    for event in tree:
-        nEvents += 1
-
-        g = Photons(event)
-        if nEvents % 5 == 0:
-            print("Event number: {0} Total number of photons: {1}".format(nEvents, g.nPhotons()))
-
-        #Loop over photons in the event
-        nP = 0
-        for i, _ in np.ndenumerate(g.pos_final_x):
-            x, y, z, t, w = 10*g.x(i), 10*g.y(i), 20*g.z(i) + 2000, g.t(i), g.w[i]
-            r = math.sqrt(x**2 + y**2)
-            isCFiber = bool(g.isCoreC[i])
-            #isCFiber = bool(g.isCoreC[i])
-            isGoodPhoton = g.zEnd(i)>0 and g.t(i)>0.0 and g.t(i)<40.0
-            if isCFiber and isGoodPhoton:
-                nP += 1
-                for c in nChannels:
-                    histos["nPhotons_xyt_all_{}".format(c.name)].Fill(y, x, t, w)          
-                    histos["nPhotons_rte_all_{}".format(c.name)].Fill(r, t, nEvents, w)          
-                    histos["nPhotons_rze_all_{}".format(c.name)].Fill(r, z, nEvents, w)          
-                    histos["nPhotons_tze_all_{}".format(c.name)].Fill(t, z, nEvents, w)          
-                    histos["dummy_nPhotons_xy_{}".format(c.name)].Fill(y, x, w)
-
-                    #Check if bin was hit
-                    b = histos["temp_nPhotons_xyt_oneHit_{}".format(c.name)].FindBin(y, x)
-                    nPhotonsInBin = histos["temp_nPhotons_xyt_oneHit_{}".format(c.name)].GetBinContent(b)
-                    if nPhotonsInBin < 1:
-                        histos["nPhotons_xyt_oneHit_{}".format(c.name)].Fill(y, x, t, w)
-                        histos["nPhotons_rte_oneHit_{}".format(c.name)].Fill(r, t, nEvents, w)
-                        histos["nPhotons_rze_oneHit_{}".format(c.name)].Fill(r, z, nEvents, w)
-                        histos["nPhotons_tze_oneHit_{}".format(c.name)].Fill(t, z, nEvents, w)
-                        histos["temp_nPhotons_xyt_oneHit_{}".format(c.name)].Fill(y, x, w)
-        #print(nP)
-        #Clear temp histos
-        for c in nChannels: 
-            # Fill the nPhotons per channel summary histogram
-            h = histos["dummy_nPhotons_xy_{}".format(c.name)]
-            for bx in range(1, h.GetXaxis().GetNbins()+1):
-                 for by in range(1, h.GetYaxis().GetNbins()+1):
-                      nPhotonsPerChannel = h.GetBinContent(bx, by)
-                      histos["nPhotonsPerChannel_{}".format(c.name)].Fill(nPhotonsPerChannel)
-            histos["dummy_nPhotons_xy_{}".format(c.name)].Reset()
-            histos["temp_nPhotons_xyt_oneHit_{}".format(c.name)].Reset()
-       
-
-    # Draw and save histos
-    c1 = ROOT.TCanvas( "c", "c", 800, 700)
-    ROOT.gStyle.SetOptFit(1)
-    ROOT.gPad.SetLeftMargin(0.12)
-    ROOT.gPad.SetRightMargin(0.15)
-    ROOT.gPad.SetTopMargin(0.08)
-    ROOT.gPad.SetBottomMargin(0.12)
-    ROOT.gPad.SetTicks(1,1)
-    # for c in nChannels: saveHisto(c1, histos, "nPhotons_xy_{}".format(c.name), "colz")
-
-    # Write everything out
-    root_file.Write()
-    #tree.Write()
-    root_file.Close()
-        
+    nextEntry = first
+    nEvents, nPhotonsAll, nPhotonsGood = 0, 0, 0
+    loopStart = time.perf_counter()
+    try:
+        for entry, nPhotons, xs, ys, zs, ts, ws in photonSource:
+            stats.count("events")
+            stats.count("photons", nPhotons)
+            nEvents, nPhotonsAll, nPhotonsGood = nEvents + 1, nPhotonsAll + nPhotons, nPhotonsGood + len(xs)
+            iEvent = eventOffset + entry
+            if iEvent % 5 == 0:
+                print("Event number: {0} Total number of photons: {1}".format(iEvent, nPhotons))
+            processPhotons(histos, pixelMaps, nChannels, iEvent, xs, ys, zs, ts, ws, spad, synth, dark, args.noise)
+            nextEntry = entry + 1
+
+            # Counted even with checkpointing off, e.g. a --resume run without the checkpoint options,
+            # so the events after the last segment always end up in one more segment
+            if ckpt.tick():
+                segmentPath = ckpt.nextSegmentPath()
+                writeOutput(segmentPath, histos, pixelMaps, deltaPath(segmentPath))
+                resetHistos(histos, pixelMaps)
+                ckpt.commit(segmentPath, nextEntry)
+                print("Checkpoint written at entry {}".format(nextEntry))
+    except BaseException:
+        photonSource.close()
+        if cacheWriter is not None: cacheWriter.abort()
+        raise
+    loopSeconds = time.perf_counter() - loopStart
+    if cacheWriter is not None: cacheWriter.close()
+    input_file.Close()
+
+    if cache is None and nEvents > 0:
+        # What branch pruning and the selection in the reader save, per event
+        stats.count("compressed bytes read", int(bytesRead*nEvents/entriesInTree))
+        stats.count("compressed bytes skipped", int((bytesTotal - bytesRead)*nEvents/entriesInTree))
+        stats.count("column bytes not materialized", (nPhotonsAll - nPhotonsGood)*photonBytes)
+        print("Reader: {:.1f} of {:.1f} kB compressed per entry read; {:.0f} of {:.0f} photons per event kept, {:.2f} MB of columns per event not materialized".format(
+            bytesRead/1024.0/entriesInTree, bytesTotal/1024.0/entriesInTree,
+            nPhotonsGood/nEvents, nPhotonsAll/nEvents, (nPhotonsAll - nPhotonsGood)*photonBytes/1024.0**2/nEvents))
+    if nEvents > 0:
+        print("Event loop: {} events in {:.1f} s, {:.2f} events/s".format(nEvents, loopSeconds, nEvents/max(loopSeconds, 1e-9)))
+    if prefetcher is not None:
+        print(prefetcher.summary())
+
+    if ckpt.segments:
+        # The last stretch becomes one more segment, then the segments add up to the output
+        if ckpt.eventsSince > 0:
+            segmentPath = ckpt.nextSegmentPath()
+            writeOutput(segmentPath, histos, pixelMaps, deltaPath(segmentPath))
+            ckpt.commit(segmentPath, nextEntry)
+        with stats.stage("merge", len(ckpt.segments)):
+            mergeFiles(ckpt.segments, output_file_path + ".tmp")
+        writeDeltas(output_file_path + ".tmp", histos, pixelMaps, ckpt.deltaPaths())
+        os.replace(output_file_path + ".tmp", output_file_path)
+        ckpt.remove()
+    else:
+        writeOutput(output_file_path, histos, pixelMaps)
+
+    print("Peak RSS: {:.1f} MB (xyt pixel maps: {:.1f} MB, {} backend)".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+        sum(m.nbytes() for m in pixelMaps.values())/1024.0**2, args.pixel_map_backend))
+
+def getEntries(input_file_path):
+    input_file = ROOT.TFile(input_file_path, "READ")
+    nEntries = input_file.Get("tree").GetEntries()
+    input_file.Close()
+    return nEntries
+
+def simulateJob(job):
+    # Process pool entry point: one entry range of one file into its own partial output
+    stats.enable(stats.enabled)
+    if job["args"].resume and os.path.exists(job["output"]) and not os.path.exists(job["output"] + ".ckpt"):
+        # Finished before the interruption
+        return job
+    simulate(job["input"], job["output"], job["args"], job["first"], job["last"], job["eventOffset"])
+    job["stats"] = stats.snapshot()
+    return job
+
+def planJobs(input_file_paths, partDir, args):
+    """
+    One job per input file. A single input file is instead split into
+    args.jobs entry ranges. Events are numbered consecutively across files.
+    """
+    jobs = []
+    eventOffset = 0
+    for k, input_file_path in enumerate(input_file_paths):
+        nEntries = getEntries(input_file_path)
+        nSplit = args.jobs if len(input_file_paths) == 1 else 1
+        bounds = [int(b) for b in np.linspace(0, nEntries, nSplit + 1)]
+        for i in range(nSplit):
+            if bounds[i] == bounds[i+1]: continue
+            jobs.append({
+                "input": input_file_path,
+                "output": os.path.join(partDir, "part_{}_{}.root".format(k, i)),
+                "args": args,
+                "first": bounds[i],
+                "last": bounds[i+1],
+                "eventOffset": eventOffset,
+            })
+        eventOffset += nEntries
+    return jobs
+
+def simulateFiles(input_file_paths, output_file_path, args):
+    """
+    Simulate several input files (or one file split into entry ranges) on a
+    pool of args.jobs worker processes. Each job writes a partial output and
+    the partial outputs are added up into output_file_path in input order.
+    Returns the manifest of what every job processed and the summed run
+    statistics of all jobs.
+    """
+    total = RunStats()
+
+    # Fixed location, so a --resume run finds the parts and their checkpoints again
+    partDir = output_file_path + ".parts"
+    os.makedirs(partDir, exist_ok=True)
+    jobs = planJobs(input_file_paths, partDir, args)
+
+    if args.jobs > 1:
+        # A worker that dies (e.g. killed when out of memory) raises BrokenProcessPool here instead of hanging the run
+        with concurrent.futures.ProcessPoolExecutor(min(args.jobs, len(jobs))) as pool:
+            done = list(pool.map(simulateJob, jobs))
+    else:
+        done = [simulateJob(job) for job in jobs]
+
+    for job in done:
+        if "stats" in job: total.merge(job["stats"])
+
+    start = time.perf_counter()
+    mergeTree([job["output"] for job in done], output_file_path + ".tmp", args.jobs)
+    os.replace(output_file_path + ".tmp", output_file_path)
+    shutil.rmtree(partDir)
+    total.add("merge", time.perf_counter() - start, len(done))
+
+    manifest = [{
+        "input": os.path.abspath(job["input"]),
+        "firstEntry": job["first"],
+        "lastEntry": job["last"],
+        "eventsProcessed": job["last"] - job["first"],
+        "firstEvent": job["eventOffset"] + job["first"],
+    } for job in done]
+    return manifest, total.snapshot()
+
+def existingChannels(output_file_path):
+    # Names of the SiPMs (e.g. "20x20") that already have a full set of histograms in an output
+    f = ROOT.TFile.Open(output_file_path, "READ")
+    names = histNames(f)
+    f.Close()
+    channels = []
+    for name in names:
+        if not name.startswith("nPhotonsPerChannel_"): continue
+        c = name[len("nPhotonsPerChannel_"):]
+        if all("nPhotons_{}_{}_{}".format(t, sel, c) in names for t in ("xyt", "rte", "rze", "tze") for sel in ("all", "oneHit")):
+            channels.append(c)
+    return channels
+
+def planPitchScan(args, manifest_path):
+    """
+    Incremental pitch scan: the SiPMs of args.pitches that are not in the
+    existing output yet. The inputs and the run settings must be the ones
+    the output was made with, as recorded in its manifest, otherwise old and
+    new pitches would not describe the same events and the same physics.
+    """
+    nChannels = getChannels(args.pitches)
+    if not os.path.exists(args.output):
+        return nChannels
+    if not os.path.exists(manifest_path):
+        raise RuntimeError("{} has no manifest ({}), so its inputs and settings cannot be checked".format(args.output, manifest_path))
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    previous = sorted(set(m["input"] for m in manifest["files"]))
+    if previous != sorted(set(os.path.abspath(p) for p in args.input_files)):
+        raise RuntimeError("{} was made from other inputs: {}".format(args.output, previous))
+    settings = runSettings(args)
+    previousSettings = manifest.get("settings") or {}
+    if previousSettings.get("deadTime") is not None and np.isinf(previousSettings["deadTime"]):
+        # Manifests written before the None convention hold Infinity
+        previousSettings["deadTime"] = None
+    if previousSettings != settings:
+        changed = sorted(k for k in settings if previousSettings.get(k, None) != settings[k])
+        raise RuntimeError("{} was made with other settings ({}): {} != {}".format(args.output, ", ".join(changed), previousSettings, settings))
+    done = existingChannels(args.output)
+    missing = [c for c in nChannels if c.name not in done]
+    print("Pitches already in {}: {}; to add: {}".format(args.output, ", ".join(done) or "none", ", ".join(c.name for c in missing) or "none"))
+    return missing
+
+def expandInputs(inputs):
+    """
+    Input files can be given as paths, glob patterns (quoted, so the shell
+    leaves them alone) or text files listing one path per line.
+    """
+    paths = []
+    for item in inputs:
+        if item.endswith(".txt") or item.endswith(".list"):
+            with open(item) as f:
+                paths += expandInputs([l.strip() for l in f if l.strip() and not l.startswith("#")])
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item))
+            if not matches:
+                print("⚠️ Warning: no files match {}".format(item))
+            paths += matches
+        else:
+            paths.append(item)
+    return paths
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Simulate digital SiPM pixel occupancy from Geant4 optical photons")
+    parser.add_argument("input_files", nargs="*", help="Geant4 ROOT files with the photon tree: paths, glob patterns or .txt/.list file lists")
+    parser.add_argument("-o", "--output", default="outfile.root", help="Merged output file")
+    parser.add_argument("--chunk-size", type=int, default=100, help="Number of events read from the tree at a time")
+    parser.add_argument("--prefetch", type=int, default=2, help="Chunks read ahead in a background thread while the current one is processed (0: off); bounds the read-ahead memory")
+    parser.add_argument("--pixel-map-backend", choices=list(pixelMapBackends), default="sparse", help="Storage for the nPhotons_xyt maps until they are written out")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes the input files (or a single file's entry range) are spread over")
+    parser.add_argument("--checkpoint-every", type=int, default=0, help="Write a checkpoint every N events (0: off)")
+    parser.add_argument("--checkpoint-minutes", type=float, default=0.0, help="Write a checkpoint every M minutes (0: off)")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its last checkpoint")
+    parser.add_argument("--pitches", type=lambda spec: [int(p) for p in spec.split(",")], help="Comma separated SiPM pitches in um (default: the production list)")
+    parser.add_argument("--incremental", action="store_true", help="Only simulate the pitches missing from the output and add them to it")
+    parser.add_argument("--dead-time", type=float, default=float("inf"), help="SPAD dead time in ns; the oneHit histograms then count every detected photon, not only the first per pixel (default: infinite)")
+    parser.add_argument("--recovery-time", type=float, default=0.0, help="Time constant in ns of the detection efficiency recovery after the dead time (0: full efficiency right away)")
+    parser.add_argument("--time-bins", type=int, default=1, help="Number of 5-40 ns time bins of the xyt maps")
+    parser.add_argument("--waveforms", action="store_true", help="Also synthesize the SiPM waveforms and write their sum as signal_time_*")
+    parser.add_argument("--amplitude", type=float, default=8.0, help="Waveform amplitude of one fired pixel in mV")
+    parser.add_argument("--gain-spread", type=float, default=0.0, help="Relative channel-to-channel gain spread of the waveforms")
+    parser.add_argument("--noise", type=float, default=0.0, help="Electronic noise of the waveforms in mV per sample")
+    parser.add_argument("--dark-rate", type=float, default=0.0, help="SPAD dark count rate in Hz/mm^2 (0: off)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the per-event random streams")
+    parser.add_argument("--event-axis", choices=["bins", "reduce"], default="bins", help="rte/rze/tze events axis: 100 event bins, or one bin plus streaming event-to-event statistics (see eventReducer.py)")
+    parser.add_argument("--event-quantiles", action="store_true", help="With --event-axis reduce, also keep what is needed for per-bin quantiles")
+    parser.add_argument("--time-window", type=float, nargs=2, default=[0.0, 40.0], metavar=("TMIN", "TMAX"), help="Photon selection: arrival time window in ns")
+    parser.add_argument("--z-end-min", type=float, default=0.0, help="Photon selection: minimum OP_pos_final_z")
+    parser.add_argument("--all-fibers", action="store_true", help="Photon selection: keep photons of every fiber type, not only the Cherenkov cores")
+    parser.add_argument("--photon-cache", help="Directory of the cache of selected, transformed photons; reruns on the same input skip the tree")
+    parser.add_argument("--report", action="store_true", help="Time every stage and write a JSON run report next to the output")
+    args = parser.parse_args()
+    args.input_files = expandInputs(args.input_files)
+    if not args.input_files:
+       print("❌ Error: please provide a ROOT file as argument.")
+       sys.exit(1)
+    return args
+
+def main():
+    # Some useful hardcoded stuff
+    args = parseArgs()
+    os.makedirs("output/", exist_ok=True)
+
+    print(getNBins(xBinL,xBinH,0.01))
+
+    manifest_path = os.path.splitext(args.output)[0] + "_manifest.json"
+    output_file_path = args.output
+    if args.incremental and os.path.exists(args.output):
+        missing = planPitchScan(args, manifest_path)
+        if not missing:
+            print("Nothing to do: every pitch is already in {}".format(args.output))
+            return
+        # Simulate the new pitches on their own, then add them to the output
+        args.pitches = [c.channelSize for c in missing]
+        output_file_path = args.output + ".newPitches"
+
+    stats.enable(args.report)
+    if len(args.input_files) == 1 and args.jobs == 1:
+        nEntries = getEntries(args.input_files[0])
+        simulate(args.input_files[0], output_file_path, args)
+        manifest = [{"input": os.path.abspath(args.input_files[0]), "firstEntry": 0, "lastEntry": nEntries, "eventsProcessed": nEntries, "firstEvent": 0}]
+        runStats = stats.snapshot()
+    else:
+        manifest, runStats = simulateFiles(args.input_files, output_file_path, args)
+
+    if output_file_path != args.output:
+        combineFiles([args.output, output_file_path], args.output + ".tmp")
+        os.replace(args.output + ".tmp", args.output)
+        os.remove(output_file_path)
+
+    if args.report:
+        writeReport(os.path.splitext(args.output)[0] + "_report.json", runStats,
+                    output=os.path.abspath(args.output), inputs=[m["input"] for m in manifest], jobs=args.jobs)
+
+    # Record which events of which files went into the output
+    with open(manifest_path, "w") as f:
+        json.dump({"output": os.path.abspath(args.output), "files": manifest, "channels": existingChannels(args.output), "settings": runSettings(args)}, f, indent=2)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,90 @@
+import numpy as np
+import ROOT
+
+# Time grid of the signal_time histograms
+nSamples = 500
+tLo = 0.0
+tHi = 25.0
+
+def pulseTemplate(dt, tPre=2.0, tPost=25.0):
+    """
+    SiPM response to one photon at t = 0, sampled every dt ns from -tPre to
+    tPost: the landau(0)+gaus(3) shape of getSiPMResponse in oldCode, with
+    its peak scaled to 1/0.9. Evaluated once, then only shifted and added.
+    """
+    x = np.arange(-int(round(tPre/dt)), int(round(tPost/dt)) + 1)*dt
+    landau = np.array([ROOT.TMath.Landau(v, 0.0, 0.2) for v in x])
+    shape = 0.5*landau + 1.0*np.exp(-0.5*(x/0.25)**2)
+    return shape/(0.9*shape.max()), int(round(tPre/dt))
+
+def channelGains(channels, spread, seed=0):
+    """
+    Relative gain 1 + spread*N(0, 1) of each channel. The normal numbers come
+    from a hash of (seed, channel), so a channel keeps its gain across
+    events and workers without a per-channel table in memory.
+    """
+    channels = np.asarray(channels)
+    if spread == 0:
+        return np.ones(len(channels))
+    def splitmix(z):
+        z = (z + np.uint64(0x9E3779B97F4A7C15))
+        z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+    with np.errstate(over="ignore"):
+        h1 = splitmix(channels.astype(np.uint64) ^ splitmix(np.full(len(channels), seed, dtype=np.uint64)))
+        h2 = splitmix(h1)
+    u1 = ((h1 >> np.uint64(11)).astype(np.float64) + 0.5)/2.0**53
+    u2 = (h2 >> np.uint64(11)).astype(np.float64)/2.0**53
+    return 1.0 + spread*np.sqrt(-2.0*np.log(u1))*np.cos(2.0*np.pi*u2)
+
+def convolve(counts, template, offset, method="auto"):
+    """
+    Convolve every row of counts with the template, keeping the first
+    counts.shape[-1] samples; offset is the template sample of t = 0. Long
+    traces go through an FFT, short ones are summed tap by tap.
+    """
+    counts = np.atleast_2d(counts)
+    n, k = counts.shape[1], len(template)
+    if method == "fft" or (method == "auto" and k > 64):
+        size = 1 << int(np.ceil(np.log2(n + k - 1)))
+        full = np.fft.irfft(np.fft.rfft(counts, size, axis=1)*np.fft.rfft(template, size), size, axis=1)
+        return full[:, offset:offset + n]
+    out = np.zeros(counts.shape)
+    for j, a in enumerate(template):
+        shift = j - offset
+        if shift >= 0:
+            out[:, shift:] += a*counts[:, :n - shift]
+        else:
+            out[:, :shift] += a*counts[:, -shift:]
+    return out
+
+class WaveformSynth:
+    """
+    Analog sum of the fired channels of an event: the hit times are binned
+    on the signal_time grid, weighted by amplitude [mV] times the gain of
+    their channel, and convolved with the pulse template once.
+    """
+    def __init__(self, amplitude=8.0, gainSpread=0.0, seed=0, nSamples=nSamples, tLo=tLo, tHi=tHi):
+        self.amplitude = amplitude
+        self.gainSpread = gainSpread
+        self.seed = seed
+        self.nSamples, self.tLo, self.tHi = nSamples, tLo, tHi
+        self.dt = (tHi - tLo)/nSamples
+        self.template, self.offset = pulseTemplate(self.dt)
+
+    def timeBins(self, ts):
+        # Sample of each hit; hits outside the grid are dropped
+        b = np.floor((np.asarray(ts) - self.tLo)/self.dt).astype(np.int64)
+        return b, (b >= 0) & (b < self.nSamples)
+
+    def summed(self, channels, ts):
+        """
+        Sum of the waveforms of all channels, i.e. the analog sum of the
+        SiPM. Convolution is linear, so the gain-weighted hit times are
+        convolved once instead of channel by channel.
+        """
+        b, ok = self.timeBins(ts)
+        weights = self.amplitude*channelGains(np.asarray(channels)[ok], self.gainSpread, self.seed)
+        counts = np.bincount(b[ok], weights=weights, minlength=self.nSamples)
+        return convolve(counts, self.template, self.offset)[0]